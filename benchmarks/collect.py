@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+'''
+Measure full collections of all metrics from a synthetic Workbook (See
+fake_workbook.py). Reports wall time, CPU time, calls to Workbook and
+peak memory of every collection, so the effect of changes (Like workers,
+the asyncio engine or the cache) can be measured without a live Workbook.
+
+The collector is set up by make_collector() from the config file (Without
+collecting in the background), with the options below overriding it.
+
+Run from the root of the repository, like:
+python3 benchmarks/collect.py --employees 2000 --jobs 20000 --latency 0.05
+python3 benchmarks/collect.py --engine asyncio --cycles 3
+'''
+
+import argparse
+import logging
+import os
+import resource
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import workbook_exporter
+from fake_workbook import FakeWorkbookAPI, AsyncFakeWorkbookAPI
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Benchmark collections from a synthetic Workbook')
+
+    parser.add_argument('--conf-file', help='Config file to set up the collector with',
+        default=os.path.join(os.path.dirname(__file__), '..', 'workbook_exporter.yml'))
+    parser.add_argument('--cycles', type=int, default=3, help='Collections to run')
+    parser.add_argument('--engine', choices=['threads', 'asyncio'], help='Engine to get data with')
+    parser.add_argument('--workers', type=int, help='Workers (Connections) to get data with')
+    parser.add_argument('--aggregation-processes', type=int,
+        help='Processes collecting metrics pr. company')
+    parser.add_argument('--no-cache', action='store_true', help='Do not cache data between collections')
+    parser.add_argument('--incremental', action='store_true', help='Get time entries incrementally')
+    parser.add_argument('--no-dates', action='store_true',
+      help='Leave the (Undocumented) date of the work out of time entries')
+    parser.add_argument('--trace-memory', action='store_true',
+        help='Report peak memory allocated by Python pr. collection (Slows down collections)')
+
+    # Size of the synthetic Workbook
+    parser.add_argument('--companies', type=int, default=2)
+    parser.add_argument('--departments', type=int, default=20)
+    parser.add_argument('--employees', type=int, default=2000)
+    parser.add_argument('--customers', type=int, default=2000)
+    parser.add_argument('--jobs', type=int, default=20000)
+    parser.add_argument('--time-entries', type=int, default=50000)
+    parser.add_argument('--creditors', type=int, default=500)
+    parser.add_argument('--debtors', type=int, default=500)
+    parser.add_argument('--accounts', type=int, default=25)
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds every call to Workbook takes')
+    parser.add_argument('--seed', type=int, default=1)
+
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    logging.basicConfig(level=logging.ERROR)
+
+    start_time = time.perf_counter()
+    backend = FakeWorkbookAPI(
+      companies=args.companies,
+      departments=args.departments,
+      employees=args.employees,
+      customers=args.customers,
+      jobs=args.jobs,
+      time_entries=args.time_entries,
+      dated=not args.no_dates,
+      creditors=args.creditors,
+      debtors=args.debtors,
+      accounts=args.accounts,
+      latency=args.latency,
+      seed=args.seed)
+    print("Generated synthetic Workbook in {:.1f}s".format(time.perf_counter() - start_time))
+
+    config = workbook_exporter.parse_config(args.conf_file)
+    workbook_exporter.JOB_AGE_BUCKETS = config['data']['job_age_buckets']
+    workbook_exporter.CLIENT_AGE_BUCKETS = config['data']['client_age_buckets']
+
+    # Collect on every call to collect(), from all companies
+    config.setdefault('exporter', {})['refresh_interval'] = 0
+    config['workbook']['companies'] = []
+    if args.engine:
+      config['workbook']['engine'] = args.engine
+    if args.workers:
+      config['workbook']['workers'] = args.workers
+    if args.aggregation_processes is not None:
+      config['workbook']['aggregation_processes'] = args.aggregation_processes
+    if args.no_cache:
+      config.setdefault('cache', {})['ttl'] = {}
+    if args.incremental:
+      config.setdefault('time_entries', {})['incremental'] = True
+
+    # A CoalescingCollector wrapping the WorkbookCollector
+    collector = workbook_exporter.make_collector(config, 'http://fake', 'user', 'password')
+    collector.collector.wb.wb = backend
+
+    # The asyncio engine makes its own requests
+    workbook_exporter.AsyncWorkbookAPI = \
+      lambda *a, **kw: AsyncFakeWorkbookAPI(backend, *a, **kw)
+
+    print("Engine {}, {} workers, {} aggregation processes, latency {}s, {} companies, {} employees, {} jobs, {} time entries"
+      .format(collector.collector.engine, collector.collector.workers,
+        collector.collector.aggregation_processes, args.latency, args.companies,
+        args.employees, args.jobs, args.time_entries))
+    print("{:>5} {:>9} {:>9} {:>7} {:>8} {:>12}".format(
+      'Cycle', 'Wall (s)', 'CPU (s)', 'Calls', 'Metrics', 'Peak (MiB)'))
+
+    if args.trace_memory:
+      tracemalloc.start()
+
+    for cycle in range(1, args.cycles + 1):
+      backend.calls.clear()
+      if args.trace_memory:
+        tracemalloc.reset_peak()
+
+      wall_start = time.perf_counter()
+      cpu_start = time.process_time()
+      metrics = list(collector.collect())
+      wall = time.perf_counter() - wall_start
+      cpu = time.process_time() - cpu_start
+
+      if args.trace_memory:
+        peak = '{:.1f}'.format(tracemalloc.get_traced_memory()[1] / 2**20)
+      else:
+        peak = '-'
+
+      print("{:>5} {:>9.3f} {:>9.3f} {:>7} {:>8} {:>12}".format(
+        cycle, wall, cpu, sum(backend.calls.values()), len(metrics), peak))
+
+    print("Calls in the last cycle: {}".format(
+      ", ".join("{} {}".format(n, c) for n, c in sorted(backend.calls.items()))))
+
+    # Linux reports KiB
+    print("Max resident memory of the process: {:.1f} MiB".format(
+      resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,331 @@
+#!/usr/bin/env python3
+'''
+A stand-in for workbook_api.WorkbookAPI, serving a synthetic Workbook
+(Tenant) of configurable size from memory. Every call takes latency
+seconds, to act like a Workbook on the other side of a network.
+
+Used by the benchmarks, to measure the exporter without a live Workbook:
+
+  backend = FakeWorkbookAPI(employees=2000, jobs=20000, latency=0.05)
+  collector.wb.wb = backend
+'''
+
+import asyncio
+import bisect
+import collections
+from datetime import datetime, timedelta
+import os
+import random
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from workbook_exporter import AsyncWorkbookAPI, EMPLOYEE_HOURS_CAPACITY_FIELDS
+
+
+def wb_time(d):
+    '''Returns datetime d as a Workbook time string'''
+    return d.strftime("%Y-%m-%dT%H:%M:%S.") + "{:03d}Z".format(d.microsecond // 1000)
+
+
+def parse_iso(value):
+    '''Returns the datetime in ISO string value, as sent by the exporter'''
+    return datetime.fromisoformat(value.rstrip('Z'))
+
+
+class FakeWorkbookAPI(object):
+    '''The calls of workbook_api.WorkbookAPI used by the exporter, answered
+    with synthetic data. The same seed gives the same data.
+
+    Keyword arguments:
+    companies (Int): Number of companies
+    departments (Int): Number of departments, spread over the companies
+    employees (Int): Number of employees, spread over the departments
+    customers (Int): Number of customers
+    jobs (Int): Number of jobs, spread over companies and customers
+    time_entries (Int): Number of time entries, spread over the last days
+    days (Int): Days back to add time entries for
+    dated (Bool): Give time entries the date of the work. Not documented by Workbook.
+    creditors (Int): Number of creditors
+    debtors (Int): Number of debtor balances pr. company
+    accounts (Int): Number of finance accounts pr. company
+    latency (Float): Seconds every call takes
+    seed (Int): Seed for the random data
+    '''
+
+    # The calls to Workbook made by the exporter
+    CALLS = [
+      'get_capacity_profiles',
+      'get_companies',
+      'get_company',
+      'get_costumers',
+      'get_creditors',
+      'get_currencies',
+      'get_debtors_balance',
+      'get_departments',
+      'get_employee_prices_hour',
+      'get_employees',
+      'get_finance_account_balance',
+      'get_finance_accounts',
+      'get_jobs',
+      'get_time_entries',
+      ]
+
+    def __init__(self, companies=2, departments=20, employees=2000,
+        customers=2000, jobs=20000, time_entries=50000, days=7, dated=True,
+        creditors=500, debtors=500, accounts=25, latency=0, seed=1):
+        r = random.Random(seed)
+        now = datetime.now()
+
+        self.latency = latency
+
+        # Number of calls made pr. call name
+        self.calls = collections.Counter()
+        self.lock = threading.Lock()
+
+        self.currencies = [
+          {'Id': 1, 'Iso4127': 'DKK'},
+          {'Id': 2, 'Iso4127': 'EUR'},
+          ]
+
+        self.companies = {c: {
+          'Id': c,
+          'Name': 'Company {}'.format(c),
+          'Active': True,
+          'CurrencyID': 1 + (c - 1) % len(self.currencies),
+          } for c in range(1, companies + 1)}
+
+        self.departments = [{
+          'Id': d,
+          'Name': 'Department {}'.format(d),
+          'CompanyId': 1 + d % companies,
+          } for d in range(1, departments + 1)]
+
+        self.employees = []
+        for e in range(1, employees + 1):
+          department = self.departments[e % departments]
+          self.employees.append({
+            'Id': e,
+            'EmployeeName': 'Employee {}'.format(e),
+            'CompanyId': department['CompanyId'],
+            'DepartmentId': department['Id'],
+            'TimeRegistration': r.random() < 0.9,
+            'HireDate': wb_time(now - timedelta(days=r.randint(1, 15 * 365))),
+            'Active': True,
+            })
+
+        # Everyone changed capacity profile once
+        self.capacity_profiles = {}
+        for e in self.employees:
+          self.capacity_profiles[e['Id']] = [
+            dict({'Id': 2 * e['Id'] + i, 'ResourceId': e['Id'],
+              'ValidFrom': wb_time(now - timedelta(days=400 - 200 * i))},
+              **{f: r.choice([0, 6, 7.5, 8]) for f in EMPLOYEE_HOURS_CAPACITY_FIELDS})
+            for i in range(2)]
+
+        # Some customers were never won
+        self.customers = {c: {
+          'Id': c,
+          'Name': 'Customer {}'.format(c),
+          'WonDate': wb_time(now - timedelta(days=r.randint(1, 3000)))
+            if r.random() < 0.9 else None,
+          } for c in range(1, customers + 1)}
+
+        # Jobs pr. company
+        self.jobs = collections.defaultdict(list)
+        for j in range(1, jobs + 1):
+          company_id = 1 + j % companies
+          self.jobs[company_id].append({
+            'Id': j,
+            'CompanyId': company_id,
+            'CustomerId': r.randint(1, customers),
+            'Billable': r.random() < 0.7,
+            'StatusId': r.randint(0, 5),
+            'CreateDate': wb_time(now - timedelta(days=r.randint(1, 1000))),
+            })
+
+        # Time entries sorted by date, so pages can be found with bisect
+        dates = sorted(now - timedelta(days=r.random() * days)
+          for _ in range(time_entries))
+        self.time_entry_dates = dates
+        self.time_entries = [{
+          'Id': t,
+          'ResourceId': r.randint(1, employees),
+          'JobId': r.randint(1, jobs),
+          'Hours': r.choice([0.25, 0.5, 1, 2, 3.5, 7.5]),
+          'Billable': r.random() < 0.7,
+          'Date': wb_time(d),
+          } for t, d in enumerate(dates, 1)]
+        if not dated:
+          for e in self.time_entries:
+            del e['Date']
+
+        # Prices changed once for everyone
+        self.prices = []
+        for e in self.employees:
+          for i in range(2):
+            cost = r.randint(250, 600)
+            sale = cost * r.uniform(1.2, 3)
+            self.prices.append({
+              'Id': len(self.prices) + 1,
+              'EmployeeId': e['Id'],
+              'HoursCost': cost,
+              'HoursSale': sale,
+              'Profit': (sale - cost) / sale,
+              'ValidFrom': wb_time(now - timedelta(days=300 - 100 * i)),
+              })
+
+        self.creditors = [{
+          'Id': c,
+          'CompanyId': 1 + c % companies,
+          'CurrencyId': r.choice(self.currencies)['Id'],
+          'RemainingAmountTotal': r.randint(-10000, 100000),
+          'RemainingAmountDue': r.randint(0, 20000),
+          } for c in range(1, creditors + 1)]
+
+        self.debtors = {c: [{
+          'CurrencyId': r.choice(self.currencies)['Id'],
+          'RemainingAmountTotal': r.randint(-10000, 100000),
+          'RemainingAmountDue': r.randint(0, 20000),
+          } for _ in range(debtors)] for c in self.companies.keys()}
+
+        self.accounts = [{
+          'Id': a,
+          'CompanyId': c,
+          'AccountDescription': 'Account {}'.format(a),
+          'AccountNumber': 1000 + a,
+          'TypeId': 3,
+          } for c in self.companies.keys()
+            for a in range((c - 1) * accounts + 1, c * accounts + 1)]
+
+
+    def respond(self, name, args, kwargs):
+        '''Count call name, and return its data, without the latency.
+        Returns copies, as Workbook would send new data every time.'''
+        with self.lock:
+          self.calls[name] += 1
+        return getattr(self, 'data_' + name[4:])(*args, **kwargs)
+
+
+    def __getattr__(self, name):
+        if name not in self.CALLS:
+          raise AttributeError(name)
+
+        def call(*args, **kwargs):
+          if self.latency:
+            time.sleep(self.latency)
+          return self.respond(name, args, kwargs)
+        call.__name__ = name
+        return call
+
+
+    def data_capacity_profiles(self, ResourceId, AlwaysReturnProfile=True):
+        return [dict(p) for p in self.capacity_profiles.get(ResourceId, [])]
+
+
+    def data_companies(self, active=True):
+        return [{k: v for k, v in c.items() if k != 'CurrencyID'}
+          for c in self.companies.values()]
+
+
+    def data_company(self, CompanyId):
+        return dict(self.companies[CompanyId])
+
+
+    def data_costumers(self, costumer_id=None, **kwargs):
+        if costumer_id:
+          return dict(self.customers[costumer_id])
+        return [dict(c) for c in self.customers.values()]
+
+
+    def data_creditors(self, **kwargs):
+        return [dict(c) for c in self.creditors]
+
+
+    def data_currencies(self, reporting_currency=True, including_blocked=False):
+        return [dict(c) for c in self.currencies]
+
+
+    def data_debtors_balance(self, company_id, blocked=False):
+        return [dict(d) for d in self.debtors.get(company_id, [])]
+
+
+    def data_departments(self, **kwargs):
+        return [dict(d) for d in self.departments]
+
+
+    def data_employee_prices_hour(self, **kwargs):
+        return [dict(p) for p in self.prices]
+
+
+    def data_employees(self, **kwargs):
+        company_id = kwargs.get('CompanyId')
+        return [dict(e) for e in self.employees
+          if company_id is None or e['CompanyId'] == company_id]
+
+
+    def data_finance_account_balance(self, CompanyId, AccountId):
+        return [{'Id': p, 'AmountBeginning': 1000.0 * AccountId + p}
+          for p in range(12)]
+
+
+    def data_finance_accounts(self, TypeIds=[], Companies=[], **kwargs):
+        companies = set(Companies)
+        return [dict(a) for a in self.accounts
+          if a['CompanyId'] in companies and a['TypeId'] in TypeIds]
+
+
+    def data_jobs(self, Status=[], CompanyId=None, **kwargs):
+        status = set(Status)
+        return [dict(j) for j in self.jobs.get(CompanyId, [])
+          if j['StatusId'] in status]
+
+
+    def data_time_entries(self, Start=None, End=None, **kwargs):
+        low = bisect.bisect_left(self.time_entry_dates, parse_iso(Start)) \
+          if Start else 0
+        high = bisect.bisect_right(self.time_entry_dates, parse_iso(End)) \
+          if End else len(self.time_entry_dates)
+        return [dict(t) for t in self.time_entries[low:high]]
+
+
+def async_call(name):
+    '''Returns a coroutine function answering call name from the backend'''
+    async def call(self, *args, **kwargs):
+        self.no_of_requests += 1
+        async with self.connections_semaphore:
+          if self.backend.latency:
+            await asyncio.sleep(self.backend.latency)
+          return self.backend.respond(name, args, kwargs)
+    call.__name__ = name
+    return call
+
+
+class AsyncFakeWorkbookAPI(AsyncWorkbookAPI):
+    '''The calls of AsyncWorkbookAPI answered by backend (A
+    FakeWorkbookAPI). At most connections calls are in flight at a time,
+    like the connections of AsyncWorkbookAPI.
+    '''
+
+    def __init__(self, backend, url=None, user_name=None, password=None,
+        connections=8, request_timeout=None, stats=None):
+        self.backend = backend
+        self.connections = connections
+        self.request_timeout = request_timeout
+        self.stats = stats
+        self.no_of_requests = 0
+        self.connections_semaphore = None
+
+
+    async def __aenter__(self):
+        self.connections_semaphore = asyncio.Semaphore(self.connections)
+        return self
+
+
+    async def __aexit__(self, exc_type, exc, tb):
+        pass
+
+
+for name in FakeWorkbookAPI.CALLS:
+    setattr(AsyncFakeWorkbookAPI, name, async_call(name))
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+'''
+Compare the time it takes data_to_histogram() to build histograms,
+with the nested loop implementation it replaced.
+
+Run from the root of the repository:
+python3 benchmarks/histogram.py
+'''
+
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from workbook_exporter import data_to_histogram
+
+
+def data_to_histogram_nested_loop(observations, buckets):
+    '''The implementation replaced by data_to_histogram()'''
+
+    buckets = {v:0 for v in buckets}
+
+    if not float("inf") in buckets.keys():
+        buckets[float("inf")] = 0
+
+    for o in observations:
+        for key in sorted(buckets.keys()):
+            if o <= key:
+                buckets[key] += 1
+
+    buckets_list = []
+    for key in sorted(buckets.keys()):
+        if key < float("inf"):
+            bucket_name = str(key)
+        else:
+            bucket_name = "+Inf"
+        buckets_list.append([bucket_name, buckets[key]])
+
+    return(buckets_list, sum(observations))
+
+
+def main():
+
+    # Number of observations, and times to build each histogram
+    no_of_observations = 10**5
+    repeat = 5
+
+    # Buckets as used by the exporter
+    buckets = {
+      'days_employed': [3*30, 5*30, 2*12*30+9*30, 5*12*30+8*30, 8*12*30+7*30],
+      'job_age': [15, 30, 60, 150, 300, 450, 600],
+      'debit': [-50000, -25000, -10000, 0, 10000, 25000, 50000, 100000],
+      }
+
+    r = random.Random(1)
+
+    for name, b in buckets.items():
+      low, high = min(b), max(b)
+      span = high - low
+      observations = [r.uniform(low - span / 4, high + span / 4) for _ in range(no_of_observations)]
+      # Observations on the bucket bounds must go in the bucket
+      observations[:len(b)] = b
+
+      # Both implementations must return the same histogram
+      assert data_to_histogram(observations, b) == \
+        data_to_histogram_nested_loop(observations, b)
+
+      old = min(timeit.repeat(
+        lambda: data_to_histogram_nested_loop(observations, b), number=1, repeat=repeat))
+      new = min(timeit.repeat(
+        lambda: data_to_histogram(observations, b), number=1, repeat=repeat))
+
+      print("{:15} {} observations, {} buckets: nested loop {:.4f}s, bisect {:.4f}s ({:.1f}x)"
+        .format(name, no_of_observations, len(b), old, new, old / new))
+
+
+if __name__ == '__main__':
+    main()
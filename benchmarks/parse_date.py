@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+'''
+Compare the time it takes parse_date() to convert Workbook times, with
+datetime.strptime() it replaced. Times are like those in a collection:
+CreateDate and EndDate of every job, HireDate of every employee, WonDate
+of every customer and ValidFrom of capacity profiles and prices, which
+are repeated a lot.
+
+Run from the root of the repository:
+python3 benchmarks/parse_date.py
+'''
+
+from datetime import datetime, timedelta
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from workbook_exporter import parse_date, TIME_FORMAT
+
+
+def wb_time(d):
+    '''Returns datetime d as a Workbook time string'''
+    return d.strftime("%Y-%m-%dT%H:%M:%S.") + "{:03d}Z".format(d.microsecond // 1000)
+
+
+def main():
+
+    r = random.Random(1)
+    now = datetime(2020, 8, 17, 9, 2, 23, 677000)
+
+    # Times from the same days are the same, like dates in Workbook
+    def random_day(max_days):
+      return wb_time(datetime(2020, 8, 17) - timedelta(days=r.randint(0, max_days)))
+
+    def random_time(max_days):
+      return wb_time(now - timedelta(seconds=r.randint(0, max_days * 24 * 3600),
+        milliseconds=r.randint(0, 999)))
+
+    times = []
+    # CreateDate and EndDate of 20000 jobs
+    times += [random_time(3000) for _ in range(20000)]
+    times += [random_day(3000) for _ in range(20000)]
+    # HireDate of 1000 employees
+    times += [random_day(8000) for _ in range(1000)]
+    # WonDate of 2000 customers
+    times += [random_time(8000) for _ in range(2000)]
+    # ValidFrom of 3 capacity profiles and 3 prices for 1000 employees,
+    # parsed up to three times each
+    valid_from = [random_day(1500) for _ in range(100)]
+    times += [r.choice(valid_from) for _ in range(3 * 6 * 1000)]
+
+    # Both must return the same datetimes
+    assert [parse_date(t) for t in times] == \
+      [datetime.strptime(t, TIME_FORMAT) for t in times]
+
+    def strptime():
+      for t in times:
+        datetime.strptime(t, TIME_FORMAT)
+
+    def parse_uncached():
+      for t in times:
+        parse_date.__wrapped__(t)
+
+    def parse_cached():
+      # Cache is empty at the start of every run
+      parse_date.cache_clear()
+      for t in times:
+        parse_date(t)
+
+    for name, func in [
+      ('strptime', strptime),
+      ('parse_date without cache', parse_uncached),
+      ('parse_date', parse_cached)]:
+      seconds = min(timeit.repeat(func, number=1, repeat=5))
+      print("{:25} {} times: {:.4f}s".format(name, len(times), seconds))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,24 +1,70 @@
 #!/usr/bin/env python3
 
 import argparse
+import asyncio
+import bisect
+import collections
+import concurrent.futures
+import contextvars
+import copy
+import cProfile
 from datetime import datetime, timedelta
+import functools
+import hashlib
+import http.server
+import io
+import json
 import logging
+import logging.handlers
+import multiprocessing
+import operator
 import os
+import pickle
+import pstats
+import queue
 import random
+import re
+import socket
+import stat
+import threading
 import time
-
-from prometheus_client import start_http_server, Summary
-from prometheus_client.core import GaugeMetricFamily, HistogramMetricFamily, REGISTRY
+import tracemalloc
+import types
+import urllib.parse
+
+from prometheus_client import Summary
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily, HistogramMetricFamily, REGISTRY
+from prometheus_client.exposition import MetricsHandler, choose_encoder, generate_latest
+import requests
 import workbook_api
 import yaml
 
+# Optional. Only needed by the asyncio engine
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
 # The string to use when converting times in Workbook
 # Example: 2020-08-17T09:02:23.677Z
 TIME_FORMAT = "%Y-%m-%dT%H:%M:%S.%fZ"
 
+# Matches times in TIME_FORMAT, for converting without strptime
+TIME_REGEX = re.compile(r'(\d{4})-(\d\d)-(\d\d)T(\d\d):(\d\d):(\d\d)\.(\d{1,6})Z', re.ASCII)
+
+# Max number of converted Workbook times to remember
+TIME_CACHE_SIZE = 65536
+
 # The field with the reported balance metric
 FINANCE_ACCOUNT_BALANCE_FIELD = 'AmountBeginning'
 
+# The field with the date work was done in time entries. Not documented
+# by workbook_api, so incremental syncs are turned off without it.
+TIME_ENTRY_DATE_FIELD = 'Date'
+
+# Sections of the config file a tenant can have its own settings in
+TENANT_SECTIONS = ['workbook', 'cache', 'time_entries', 'exporter']
+
 # Create a metric to track time spent and requests made.
 #REQUEST_TIME = Summary('request_processing_seconds', 'Time spent processing request')
 
@@ -40,11 +86,76 @@ EMPLOYEE_HOURS_CAPACITY_FIELDS = [
 #    time.sleep(t)
 
 
+@functools.lru_cache(maxsize=TIME_CACHE_SIZE)
 def parse_date(wb_time):
     '''
     Convert a Workbook time string to a datetime object
     '''
-    return datetime.strptime(wb_time, TIME_FORMAT)
+    m = TIME_REGEX.fullmatch(wb_time)
+
+    # Let strptime deal with anything unusual
+    if not m:
+        return datetime.strptime(wb_time, TIME_FORMAT)
+
+    year, month, day, hour, minute, second, fraction = m.groups()
+    return datetime(
+        int(year), int(month), int(day),
+        int(hour), int(minute), int(second),
+        int(fraction.ljust(6, '0')))
+
+
+class HistogramBins(object):
+    '''Observations counted in to the buckets of a histogram as they
+    arrive, so the observations themselves need not be kept.
+
+    Keyword arguments:
+    buckets (List): A list of bucket values
+    '''
+
+    def __init__(self, buckets):
+        # Sorted upper bounds of the buckets. Add "infinite" if missing
+        self.bounds = sorted(set(buckets) | {float("inf")})
+
+        # Observations in the lowest bucket they fit in
+        self.counts = [0] * len(self.bounds)
+
+        # Sum of the observations
+        self.sum = 0
+
+
+    def update(self, observations):
+        '''Count the numbers in the iterable observations'''
+        bounds = self.bounds
+        counts = self.counts
+        total = self.sum
+        for o in observations:
+            total += o
+            # NaN fits in no bucket
+            if o != o:
+                continue
+            counts[bisect.bisect_left(bounds, o)] += 1
+        self.sum = total
+
+
+    def buckets_list(self):
+        '''Returns a list of [bucket_name, cumulative value]'''
+
+        # List holding lists of [bucket_name, value]
+        buckets_list = []
+
+        # Add the cumulative bucket data to the buckets_list
+        cumulative_count = 0
+        for key, count in zip(self.bounds, self.counts):
+            cumulative_count += count
+            # Calculate bucket name
+            if key < float("inf"):
+                bucket_name = str(key)
+            else:
+                bucket_name = "+Inf"
+            # Append bucket data [name, value]
+            buckets_list.append([bucket_name, cumulative_count])
+
+        return buckets_list
 
 
 def data_to_histogram(observations, buckets):
@@ -54,43 +165,25 @@ def data_to_histogram(observations, buckets):
     observations (List): A list of numbers
     buckets (List): A list of bucket values
     '''
-    
-    # Convert buckets to a dict with bucket values as keys
-    buckets = {v:0 for v in buckets}
 
-    # Add key "infinite" if missing
-    if not float("inf") in buckets.keys():
-        buckets[float("inf")] = 0
-    
-    # Sort observations in to the bucket dict
-    for o in observations:
-        for key in sorted(buckets.keys()):
-            if o <= key:
-                buckets[key] += 1
-
-    # List holding lists of [bucket_name, value]
-    buckets_list = []
-    
-    # Add the bucket data to the buckets_list
-    for key in sorted(buckets.keys()):
-        # Calculate bucket name
-        if key < float("inf"):
-            bucket_name = str(key)
-        else:
-            bucket_name = "+Inf"
-        # Append bucket data [name, value]
-        buckets_list.append([bucket_name, buckets[key]])
+    bins = HistogramBins(buckets)
+    bins.update(observations)
 
-    return(buckets_list, sum(observations))
+    return(bins.buckets_list(), bins.sum)
 
 
 def build_histogram(observations, buckets, name, desc, label_names, label_values):
 
-    # Histogram billable (Total)
-    bucket_values, buckets_sum = data_to_histogram(
-        observations,
-        buckets
-        )
+    # Observations already counted in to buckets?
+    if isinstance(observations, HistogramBins):
+        bucket_values = observations.buckets_list()
+        buckets_sum = observations.sum
+    else:
+        # Histogram billable (Total)
+        bucket_values, buckets_sum = data_to_histogram(
+            observations,
+            buckets
+            )
 
     # Job age histogram billable
     h = HistogramMetricFamily(name, desc, labels=label_names)
@@ -102,809 +195,3974 @@ def build_histogram(observations, buckets, name, desc, label_names, label_values
     return h
 
 
-class WorkbookCollector(object):
+class Record(object):
+    '''Base of records holding only the fields the exporter uses from
+    an entity in Workbook. Subclasses list the fields in FIELDS as
+    tuples of (attribute, Workbook field, conversion). Fields missing
+    in Workbook are None.
+    '''
 
-    def __init__(self, wb_url, wb_user, wb_pass):
-        # Workbook API object
-        self.wb = workbook_api.WorkbookAPI(wb_url, wb_user, wb_pass)
+    __slots__ = ()
+
+    FIELDS = ()
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        # Returns the values of all fields of a record
+        cls.get_values = operator.attrgetter(*(f[0] for f in cls.FIELDS))
+
+    @classmethod
+    def from_wb(cls, data, **kwargs):
+        '''Returns a record with the fields from the Workbook dict data.
+        Keyword arguments are set as attributes, overriding data.'''
+        r = cls.__new__(cls)
+        for attr, field, convert in cls.FIELDS:
+          value = data.get(field)
+          setattr(r, attr, None if value is None else convert(value))
+        for attr, value in kwargs.items():
+          setattr(r, attr, value)
+        return r
+
+    def __reduce__(self):
+        # Pickling the values of records is a lot faster than the slots
+        return (restore_record, (type(self), self.get_values(self)))
+
+    def __repr__(self):
+        return "{}({})".format(type(self).__name__, ", ".join(
+          "{}={!r}".format(a, getattr(self, a)) for a in self.__slots__))
+
+
+def restore_record(cls, values):
+    '''Returns a record of class cls with the values of its fields, as
+    returned by get_values(). Used when unpickling records.'''
+    r = cls.__new__(cls)
+    for (attr, field, convert), value in zip(cls.FIELDS, values):
+      setattr(r, attr, value)
+    return r
+
+
+class Employee(Record):
+    FIELDS = (
+      ('id', 'Id', int),
+      ('name', 'EmployeeName', str),
+      ('company_id', 'CompanyId', int),
+      ('department_id', 'DepartmentId', int),
+      ('time_registration', 'TimeRegistration', bool),
+      ('hire_date', 'HireDate', parse_date),
+      )
+    __slots__ = tuple(f[0] for f in FIELDS)
 
 
-    def collect(self):
+class Department(Record):
+    FIELDS = (
+      ('id', 'Id', int),
+      ('company_id', 'CompanyId', int),
+      ('name', 'Name', str),
+      )
+    __slots__ = tuple(f[0] for f in FIELDS)
 
-        logging.info("Getting data from Workbook.")
 
-        scrape_start_time = datetime.now()
+class Job(Record):
+    FIELDS = (
+      ('id', 'Id', int),
+      ('company_id', 'CompanyId', int),
+      ('customer_id', 'CustomerId', int),
+      ('status_id', 'StatusId', int),
+      ('billable', 'Billable', bool),
+      ('create_date', 'CreateDate', parse_date),
+      )
+    __slots__ = tuple(f[0] for f in FIELDS)
 
-        # Metric for status on getting data from WB
-        workbook_up = GaugeMetricFamily(
-            'workbook_up', 'Is data beeing pulled from Workbook')
 
-        # Assume no problems with getting data from Workbook
-        wb_error = False
+class Creditor(Record):
+    FIELDS = (
+      ('id', 'Id', int),
+      ('company_id', 'CompanyId', int),
+      ('currency_id', 'CurrencyId', int),
+      ('remaining_amount_total', 'RemainingAmountTotal', float),
+      ('remaining_amount_due', 'RemainingAmountDue', float),
+      )
+    __slots__ = tuple(f[0] for f in FIELDS)
 
-        # How many requests were made to workbook?
-        no_of_wb_requests = 0
 
-        # Get all the data from WB
-        try:
+class Price(Record):
+    FIELDS = (
+      ('employee_id', 'EmployeeId', int),
+      ('valid_from', 'ValidFrom', parse_date),
+      ('hours_sale', 'HoursSale', float),
+      ('hours_cost', 'HoursCost', float),
+      ('profit', 'Profit', float),
+      )
+    __slots__ = tuple(f[0] for f in FIELDS)
 
-            # A dictionary mapping id to ISO name
-            self.currencies = {c['Id']:c['Iso4127'] for c in self.wb.get_currencies()}
-            no_of_wb_requests += 1
 
-            # A dictionary mapping id to company name
-            companies = {c['Id']:c for c in self.wb.get_companies(active=True)}
-            no_of_wb_requests += 1
+def filter_companies(companies, companies_to_get):
+    '''Returns the dict of companies without the companies not in the
+    config 'companies'. All companies are kept if the list is empty.
 
-            # Delete any companies not in list in config file
-            if COMPANIES_TO_GET:
-              companies_to_delete = []
-              # Register company IDs to delete
-              for c_id in companies.keys():
-                if c_id not in COMPANIES_TO_GET:
-                  companies_to_delete.append(c_id)
+    Keyword arguments:
+    companies (Dict): Companies with company IDs as keys
+    companies_to_get (List): IDs of the companies to keep
+    '''
 
-              # Delete the company IDs from the companies dict
-              for c_id in companies_to_delete:
-                companies.pop(c_id, None)
+    # Delete any companies not in list in config file
+    if companies_to_get:
+      companies_to_delete = []
+      # Register company IDs to delete
+      for c_id in companies.keys():
+        if c_id not in companies_to_get:
+          companies_to_delete.append(c_id)
 
-            # Warn if companies in COMPANIES_TO_GET are not found in WB
-            only_in_config = set(COMPANIES_TO_GET) - set(companies.keys())
-            if only_in_config:
-              logging.warning(("Company IDs {} not in Workbook. Likely a wrong" + \
-                " ID in config 'companies'.").format(only_in_config))
+      # Delete the company IDs from the companies dict
+      for c_id in companies_to_delete:
+        companies.pop(c_id, None)
 
+    # Warn if companies in companies_to_get are not found in WB
+    only_in_config = set(companies_to_get) - set(companies.keys())
+    if only_in_config:
+      logging.warning(("Company IDs {} not in Workbook. Likely a wrong" + \
+        " ID in config 'companies'.").format(only_in_config))
 
-            # Add currency_id to companies
-            for c_id, c_data in companies.items():
-              # Get full company info from WB
-              c_info = self.wb.get_company(CompanyId=c_id)
-              no_of_wb_requests += 1
-              # Add currency to company dict
-              c_data['CurrencyId'] = c_info['CurrencyID']
+    return companies
 
 
-            # A dictionary mapping IDs to employees
-            employees = {}
-            # Get employees for all companies
-            for c_id in companies.keys():
-              for e in self.wb.get_employees(Active=True, CompanyId=c_id):
-                employees[e['Id']] = e
-              no_of_wb_requests += 1
+def pick_capacity_profile(profiles, employee):
+    '''Returns the capacity profile currently valid for an employee,
+    with the sum of work hours pr. week added as key 'hours_week'
 
+    Keyword arguments:
+    profiles (List): Capacity profiles for the employee
+    employee (Employee): The employee
+    '''
 
-            # Capacity profiles (Hours pr/week for employees)
-            # Employee ID is key
-            capacity_profiles = {}
-            for e in employees.values():
+    logging.debug("No of capacity profiles for user '{}': {}"
+      .format(employee.name, len(profiles)))
 
-              # We should only see an employee ID once
-              assert not e['Id'] in capacity_profiles.keys()
-
-              # Get all profiles for employee
-              try:
-                profiles = self.wb.get_capacity_profiles(e['Id'])
-                no_of_wb_requests += 1
-              except Exception as e:
-                logging.error("Could not get capacity profiles for employee '{}' with error: {}"
-                  .format(e['Id'], e))
-                # Abort this iteration
-                continue
+    now = datetime.now()
 
-              logging.debug("No of capacity profiles for user '{}': {}"
-                .format(e['EmployeeName'], len(profiles)))
+    # Pick 1st profile in list
+    p = profiles[-1]
+    p_valid_from = parse_date(p['ValidFrom'])
 
-              # Pick 1st profile in list
-              p = profiles[-1]
+    # Is there a newer profile in in list?
+    for x in profiles:
+      x_valid_from = parse_date(x['ValidFrom'])
+      # Abort if profile is in the future
+      if x_valid_from > now:
+        continue
+      # Use this profile, if valid from is more recent than current
+      if x_valid_from > p_valid_from:
+        p, p_valid_from = x, x_valid_from
 
-              # Is there a newer profile in in list?
-              for x in profiles:
-                # Abort if profile is in the future
-                if parse_date(x['ValidFrom']) > datetime.now():
-                  continue
-                # Use this profile, if valid from is more recent than current
-                if parse_date(x['ValidFrom']) > parse_date(p['ValidFrom']):
-                  p = x
+    logging.debug("Using capacity profile valid from {} for user '{}'"
+      .format(p['ValidFrom'], employee.name))
 
-              logging.debug("Using capacity profile valid from {} for user '{}'"
-                .format(p['ValidFrom'], e['EmployeeName']))
+    # Add calculated sum of work hours pr. week to profile
+    p['hours_week'] = 0
+    for key in p.keys():
+      if key in EMPLOYEE_HOURS_CAPACITY_FIELDS:
+        p['hours_week'] += p[key]
 
-              # Add calculated sum of work hours pr. week to profile
-              p['hours_week'] = 0
-              for key in p.keys():
-                if key in EMPLOYEE_HOURS_CAPACITY_FIELDS:
-                  p['hours_week'] += p[key]
+    return p
 
-              # Add the profile to the profiles dict 
-              capacity_profiles[e['Id']] = p
 
+def current_prices(prices):
+    '''Returns a dictionary of current prices with employee IDs as key
 
-            # A dictionary mapping IDs to departments
-            departments = {d['Id']:d for d in self.wb.get_departments()}
-            no_of_wb_requests += 1
+    Keyword arguments:
+    prices (List): Employee Price records. More than one pr. employee
+    '''
 
-            # A dictionary mapping Job IDs to jobs
-            jobs = {}
-            # Get jobs for all companies
-            for c_id in companies.keys():
-              for j in self.wb.get_jobs(Status=ACTIVE_JOBS,CompanyId=c_id):
-                jobs[j['Id']] = j
-                no_of_wb_requests += 1
+    now = datetime.now()
 
+    prices_dict = {}
+    for p in prices:
+      # Attempt to get entry for employee
+      e = prices_dict.get(p.employee_id, None)
 
-            # A dictionary mapping IDs to creditors
-            creditors = {c['Id']:c for c in self.wb.get_creditors()}
-            no_of_wb_requests += 1
+      # Add price to dict if employee is not represented
+      if not e:
+        prices_dict[p.employee_id] = p
+      # Update price?
+      else:
+        # Replace price entry, if price is newer
+        # than existing, and not in the future
+        if p.valid_from > e.valid_from and p.valid_from <= now:
+          prices_dict[p.employee_id] = p
 
+    return prices_dict
 
-            # Employee prices
-            prices = self.wb.get_employee_prices_hour(ActiveEmployees=True)
-            no_of_wb_requests += 1
 
-            # Build a dictionary of current prices with employee IDs as key
-            prices_dict = {}
-            for p in prices:
-              # Attempt to get entry for employee
-              e = prices_dict.get(p['EmployeeId'], None)
+def creditor_observations(creditors):
+    '''Returns a dict with company IDs as keys, and dicts with lists
+    of amounts owed in total, and due, as values
 
-              # Add price to dict if employee is not represented
-              if not e:
-                prices_dict[p['EmployeeId']] = p
-              # Update price?
-              else:
-                # Date objects from dates
-                current_date = parse_date(e['ValidFrom'])
-                new_date = parse_date(p['ValidFrom'])
+    Keyword arguments:
+    creditors (Iterable): Creditor records
+    '''
 
-                # Replace price entry, if price is newer
-                # than existing, and not in the future
-                if new_date > current_date and new_date <= datetime.now():
-                  prices_dict[p['EmployeeId']] = p
+    observations = {}
+    for c in creditors:
+      if c.currency_id and c.remaining_amount_total:
+        o = observations.get(c.company_id)
+        if not o:
+          o = observations[c.company_id] = {'total': [], 'due': []}
 
+        if c.remaining_amount_due:
+          o['due'].append(c.remaining_amount_due)
 
-            # Get a list of finance accounts
-            accounts = self.wb.get_finance_accounts(
-              TypeIds=FINANCE_ACCOUNT_TYPES,
-              Companies=companies.keys())
-            no_of_wb_requests += 1
-
-
-            # Add balance to accounts
-            for a in accounts:
-              balance_list = self.wb.get_finance_account_balance(
-                CompanyId=a['CompanyId'],
-                AccountId=a['Id'],
-                )
-              no_of_wb_requests += 1
-
-              # Makes sure we have data. Some typeIds do not.
-              if len(balance_list) > 0:
-                  # We want the latest balance entry.
-                  # Assume latest entry has highest ID
-                  # A dict with Ids as key
-                  b = {b['Id']:b for b in balance_list}
-                  # Get highest Id
-                  max_id = max(b.keys())
-
-                  # Add field Balance to account
-                  a['balance'] = b[max_id].get(
-                    FINANCE_ACCOUNT_BALANCE_FIELD, 0)
+        o['total'].append(c.remaining_amount_total)
 
-        except Exception as e:
-            logging.error("Could not get data from Workbook: {}".format(e))
-            # Report no data from Workbook
-            workbook_up.add_metric([], 0)
-            yield workbook_up
-            return
-        else:
-          logging.info("Done getting data from Workbook")
+    return observations
 
 
-        # FINANCE ACCOUNTS
+def add_account_balance(account, balance_list):
+    '''Add the latest balance in balance_list to the finance account
+    as key 'balance'
 
-        for a in accounts:
-          # Some account types (2?) has no balance
-          # It's only used cosmetically in Workbook
-          if a.get('balance'):
+    Keyword arguments:
+    account (Dict): The finance account
+    balance_list (List): Balance history of the account
+    '''
 
-            # Get the currency to use
-            currency_id = companies[a['CompanyId']]['CurrencyId']
-            g = GaugeMetricFamily(
-              'workbook_finance_account_balance',
-              'Balance of finance account',
-              labels=[
-                'company_id',
-                'currency',
-                'account_id',
-                'account_description',
-                'account_number'
-                ]
-              )
-            g.add_metric(
-                [str(a['CompanyId']),
-                str(self.currencies[currency_id]),
-                str(a['Id']), str(a['AccountDescription']),
-                str(a['AccountNumber'])],
-                a['balance']
-              )
-            yield g
+    # Makes sure we have data. Some typeIds do not.
+    if len(balance_list) > 0:
+        # We want the latest balance entry.
+        # Assume latest entry has highest ID
+        # A dict with Ids as key
+        b = {b['Id']:b for b in balance_list}
+        # Get highest Id
+        max_id = max(b.keys())
 
-        # Buckets for histograms
-        # Add Buckets to config
-        days_employed_buckets = [3*30, 5*30, 2*12*30+9*30, 5*12*30+8*30, 8*12*30+7*30]
-        profit_buckets = [0.2, 0.4, 0.6, 0.8]
-        hours_sale_buckets = [500, 1000, 1500, 2000]
-        hours_cost_buckets = [250, 500, 750, 1000]
+        # Add field Balance to account
+        account['balance'] = b[max_id].get(
+          FINANCE_ACCOUNT_BALANCE_FIELD, 0)
 
-        # FIXME: Credit/Debit buckets should probably be currency dependant
-        credit_buckets = [-50000, -25000, -10000, 0, 10000, 25000, 50000]
-        debit_buckets = [-50000, -25000, -10000, 0, 10000, 25000, 50000, 100000]
 
-        # FIXME: Add list of company ids to look for
-        # Days to look in to the past for timeentries
-        time_entry_days = 7
+def encode_params(params):
+    '''Returns params as a list of (key, value) tuples the way requests
+    would send them. Iterables become repeated keys, and None is left out.
+    '''
 
-        # TIME ENTRIES #
-        # Time entries don't have ClientIds
-        # FIxme: (We could look them up in jobs?)
-        # Time period to get time entries for (Time where work was done)
-        start_date = (datetime.today() - timedelta(days=time_entry_days)).isoformat()
-        end_date = datetime.today().isoformat()
+    encoded = []
+    for key, value in params.items():
+      if value is None:
+        continue
+      if isinstance(value, str) or not hasattr(value, '__iter__'):
+        value = [value]
+      for v in value:
+        encoded.append((key, str(v)))
 
-        # Top key is company_id:department_id
-        time_entries_data = {c_id:{} for c_id in companies.keys()}
+    return encoded
 
-        # Add departments
-        for c_id, c_data in time_entries_data.items():
-            for d_id, d_data in departments.items():
-                if d_data['CompanyId'] == c_id:
-                    c_data[d_id] = {
-                        'billable': 0,
-                        'total': 0,
-                        'revenue': 0,
-                        'resource_ids': set(),
-                        'job_ids': set(),
-                        'customer_ids': set()
-                        }
 
-        # TIME ENTRIES #
-        try:
-          time_entries = self.wb.get_time_entries(
-            Start=start_date, End=end_date,HasTimeRegistration=True)
-          no_of_wb_requests += 1
-        except Exception as e:
-            print("Could not get WB time entries with error: {}".format(e))
-            wb_error = True
-        else:
-            # FIXME: Number of clients worked on
-            for e in time_entries:
-                # Sometimes a resource is no longer an employee
-                if not employees.get(e['ResourceId']):
-                  #print("No longer employee: ResourceId", e['ResourceId'])
-                  continue
+class AsyncWorkbookAPI(object):
+    '''The calls of workbook_api.WorkbookAPI used by the exporter, as
+    coroutines. Requests share a pool of keep-alive connections.
+    Use as an async context manager. Requires aiohttp.
+    '''
 
-                c_id = employees[e['ResourceId']]['CompanyId']
-                d_id = employees[e['ResourceId']]['DepartmentId']
-                j_id = e['JobId']
+    def __init__(self, url, user_name, password, connections=8, request_timeout=None,
+        stats=None):
+        # The base URL of all calls to Workbook
+        self.base_url = url
 
-                if jobs.get(j_id):
-                    time_entries_data[c_id][d_id]['customer_ids'].add(jobs.get(j_id)['CustomerId'])
+        # The authentication object to use
+        self.auth = aiohttp.BasicAuth(user_name, password)
 
-                # Get hours in current time entry (If any)
-                h = e.get('Hours', 0)
+        # Max number of open connections to Workbook
+        self.connections = connections
 
-                # Register billable time
-                if e.get('Billable'):
-                    time_entries_data[c_id][d_id]['billable'] += h
+        # Max seconds to wait for connecting to, or reading from, Workbook
+        self.request_timeout = request_timeout
 
-                    try:
-                      # Get prices for employee
-                      p = prices_dict[e.get('ResourceId')]
+        # The session to use for all requests. Created on enter
+        self.session = None
 
-                      # Calculate revenue
-                      r = h * p['HoursSale']
+        # How many requests were made to workbook?
+        self.no_of_requests = 0
 
-                      # Register revenue
-                      time_entries_data[c_id][d_id]['revenue'] += r
+        # RequestStats to add the bytes of responses to. None disables.
+        self.stats = stats
 
-                    except Exception as e:
-                      logging.error("Error while calculation revenue:", e)
 
-                # Register total time
-                time_entries_data[c_id][d_id]['total'] += h
+    async def __aenter__(self):
+        self.session = aiohttp.ClientSession(
+          auth=self.auth,
+          connector=aiohttp.TCPConnector(limit=self.connections),
+          timeout=aiohttp.ClientTimeout(
+            total=None,
+            sock_connect=self.request_timeout,
+            sock_read=self.request_timeout)
+          )
+        return self
 
-                # Register person/resource
-                time_entries_data[c_id][d_id]['resource_ids'].add(e.get('ResourceId'))
 
-                # Register job
-                time_entries_data[c_id][d_id]['job_ids'].add(j_id)
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.session.close()
 
-            # Labels to use for the following metrics
-            label_names = [
-              'days',
-              'company_id',
-              'department_id',
-              'department_name'
-              ]
 
-            # Run through the time entries
-            for c_id, c_data in time_entries_data.items():
+    async def _get(self, path, params={}):
+        '''Args:
+          path: The string added to the base URL
+          params: key,value pairs to send in URL
+        '''
+        assert path[0] == '/', "Path must begin with slash"
 
-                # Get currency for company
-                currency_id = companies[c_id]['CurrencyId']
-                currency = self.currencies[currency_id]
+        self.no_of_requests += 1
 
-                for d_id, d_data in c_data.items():
-                    # Values for the labels
-                    label_values = [
-                        str(time_entry_days),
-                        str(c_id),
-                        str(d_id),
-                        departments[d_id]['Name'].strip()
-                        ]
+        async with self.session.get(self.base_url + path, params=encode_params(params)) as r:
+          # Raise exception on unexpected status code
+          if r.status != 200:
+            raise workbook_api.UnexpectedStatusCode(
+              "Got {} but expected 200".format(r.status))
 
-                    # A list of IDs of all employees in this department
-                    d_employees = [
-                      e['Id'] for e in employees.values() if \
-                      e['TimeRegistration'] and e['DepartmentId'] == d_id
-                      ]
+          body = await r.read()
+          if self.stats:
+            self.stats.add_bytes(len(body))
 
-                    g = GaugeMetricFamily(
-                      'workbook_time_entry_hours_total',
-                      'Sum of hours entered by employees', labels=label_names)
-                    g.add_metric(label_values, d_data['total'])
-                    yield g
+          return await r.json(content_type=None)
 
-                    g = GaugeMetricFamily(
-                      'workbook_time_entry_hours_billable',
-                      'Number of billable hours', labels=label_names)
-                    g.add_metric(label_values, d_data['billable'])
-                    yield g
 
-                    g = GaugeMetricFamily(
-                      'workbook_time_entry_revenue',
-                      'Billable hours times sales price pr. hour', labels=label_names + ['currency'])
-                    g.add_metric(label_values + [currency], d_data['revenue'])
-                    yield g
+    async def fan_out(self, func, items):
+        '''Await func(item) for all items concurrently
 
-                    g = GaugeMetricFamily(
-                      'workbook_time_entry_people_total',
-                      'Number of people who must enter time', labels=label_names)
-                    g.add_metric(label_values, len(d_employees))
-                    yield g
+        Returns a dict with the items as keys and the returned data as
+        values. Items where func fails are logged and left out of the dict.
+        '''
 
-                    # Sum of work hours for all employees in department
-                    sum_of_work_hours = sum([
-                      p['hours_week'] for p in capacity_profiles.values() if \
-                       p['ResourceId'] in d_employees])
+        items = list(items)
+        values = await asyncio.gather(
+          *[func(i) for i in items], return_exceptions=True)
 
-                    g = GaugeMetricFamily(
-                      'workbook_time_entry_hours_capacity_total',
-                      'Sum of hours to be entered', labels=label_names)
-                    g.add_metric(label_values, sum_of_work_hours)
-                    yield g
+        results = {}
+        for i, v in zip(items, values):
+          if isinstance(v, Exception):
+            logging.error("Call {}({}) to Workbook failed with error: {}"
+              .format(getattr(func, '__name__', func), i, repr(v)))
+          else:
+            results[i] = v
 
-                    g = GaugeMetricFamily(
-                      'workbook_time_entry_people_with_time',
-                      'Number of people having entered time entries', labels=label_names)
-                    g.add_metric(label_values, len(d_data['resource_ids']))
-                    yield g
+        return results
 
-                    g = GaugeMetricFamily(
-                      'workbook_time_entry_jobs_total',
-                      'Number of jobs with time entries', labels=label_names)
-                    g.add_metric(label_values, len(d_data['job_ids']))
-                    yield g
 
-                    g = GaugeMetricFamily(
-                      'workbook_time_entry_customers_total',
-                      'Number of customers with time entries', labels=label_names)
-                    g.add_metric(label_values, len(d_data['customer_ids']))
-                    yield g
+    async def get_capacity_profiles(self, ResourceId, AlwaysReturnProfile=True):
+        path = '/resource/{}/capacity/profiles'.format(ResourceId)
+        return await self._get(path, params={'AlwaysReturnProfile': AlwaysReturnProfile})
 
 
-        # EMPLOYEE PRICES #
-        try:
-            # Get prices for active employees
-            #prices = self.wb.get_employee_prices_hour(ActiveEmployees=True)
-            pass
-        except Exception as e:
-            print("Could not get WB employees prices with error: {}".format(e))
-            wb_error = True
+    async def get_companies(self, active=True):
+        return await self._get('/core/resourcecompany', params={'Active': active})
+
+
+    async def get_company(self, CompanyId):
+        return await self._get('/core/company/{}'.format(CompanyId))
+
+
+    async def get_costumers(self, costumer_id=None, **kwargs):
+        if costumer_id:
+          path = '/resource/customer/{}'.format(costumer_id)
         else:
-            # A dict with company id as key for dicts with EmployeeId as key.
-            # An employee can have more than 1 entry.
-            # Only store the newest. They have ValidFrom date.
-            # We don't know the company IDs  
-            price_dict = {c_id:{} for c_id in companies.keys()}
+          path = '/resource/customers'
+        return await self._get(path, params=kwargs)
+
+
+    async def get_creditors(self, **kwargs):
+        return await self._get('/finance/account/visualization/creditors', params=kwargs)
+
+
+    async def get_currencies(self, reporting_currency=True, including_blocked=False):
+        params = {
+          "ReportingCurrency": reporting_currency,
+          "IncludingBlocked": including_blocked
+          }
+        return await self._get('/core/currencies', params=params)
+
+
+    async def get_debtors_balance(self, company_id, blocked=False):
+        params = {
+          'CompanyId': company_id,
+          'Blocked': blocked
+          }
+        return await self._get('/finance/debtors/visualization/balance', params=params)
+
+
+    async def get_departments(self, **kwargs):
+        return await self._get('/core/departments', params=kwargs)
+
+
+    async def get_employees(self, **kwargs):
+        return await self._get('/resource/employees', params=kwargs)
+
+
+    async def get_finance_account_balance(self, CompanyId, AccountId):
+        params = {
+          "CompanyId": CompanyId,
+          "AccountId": AccountId
+          }
+        return await self._get('/finance/account/period/balance', params=params)
+
+
+    async def get_finance_accounts(self, **kwargs):
+        return await self._get('/finance/accounts', params=kwargs)
+
+
+    async def get_jobs(self, **kwargs):
+        return await self._get('/jobs', params=kwargs)
+
+
+    async def get_employee_prices_hour(self, **kwargs):
+        return await self._get('/settings/employee/priceshour', params=kwargs)
+
+
+    async def get_time_entries(self, **kwargs):
+        return await self._get('/personalexpense/timeentries/raw', params=kwargs)
+
+
+def freeze(value):
+    '''Returns value as something hashable. Lists, sets, dict keys
+    and dicts (As in arguments to calls to Workbook) become tuples.
+    '''
+
+    if isinstance(value, dict):
+      return tuple(sorted((k, freeze(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple, set, frozenset, type({}.keys()))):
+      return tuple(freeze(v) for v in value)
+    return value
+
+
+def fingerprint(value):
+    '''Returns a digest of the content of value (Anything which can be
+    pickled). Values with different content have different digests.
+    Values with the same content usually have the same digest.
+    '''
+    # Pickling the values of records is a lot faster than the records
+    if isinstance(value, dict):
+      value = [(k, v.get_values(v) if isinstance(v, Record) else v)
+        for k, v in value.items()]
+    return hashlib.blake2b(
+      pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL),
+      digest_size=16).digest()
+
+
+class TTLCache(object):
+    '''A cache of data returned by calls to Workbook. Entries expire after
+    a number of seconds set pr. call. The least recently used entries are
+    evicted, when there are more than max_entries.
+    '''
+
+    def __init__(self, ttls, max_entries=10000):
+        # Seconds to keep data from calls. Calls not in dict are not cached.
+        self.ttls = ttls
+
+        # Max number of entries to keep
+        self.max_entries = max_entries
+
+        # Keys are (call name, args, kwargs). Values are (expiry time, data)
+        # Least recently used first.
+        self.entries = collections.OrderedDict()
+
+        # Counters with call names as keys
+        self.hits = collections.Counter()
+        self.misses = collections.Counter()
+        self.evictions = collections.Counter()
+
+        # Protects the attributes above
+        self.lock = threading.Lock()
+
+
+    def get(self, key):
+        '''Returns (True, data) for key if cached and not expired,
+        (False, None) otherwise'''
+
+        with self.lock:
+          entry = self.entries.get(key)
+          if entry and entry[0] > time.time():
+            self.entries.move_to_end(key)
+            self.hits[key[0]] += 1
+            return True, copy.deepcopy(entry[1])
+
+          self.misses[key[0]] += 1
+          return False, None
+
+
+    def set(self, key, data):
+        '''Cache data for key for the number of seconds set for the call'''
+
+        with self.lock:
+          self.entries[key] = (time.time() + self.ttls[key[0]], copy.deepcopy(data))
+          self.entries.move_to_end(key)
+
+          # Evict least recently used entries
+          while len(self.entries) > self.max_entries:
+            evicted_key, _ = self.entries.popitem(last=False)
+            self.evictions[evicted_key[0]] += 1
+
+
+    def get_state(self):
+        '''Returns the cached entries, for saving to disk'''
+        with self.lock:
+          return collections.OrderedDict(self.entries)
+
+
+    def set_state(self, state):
+        '''Restore entries returned by get_state(). Expired entries are dropped.'''
+        with self.lock:
+          now = time.time()
+          self.entries = collections.OrderedDict(
+            (k, v) for k, v in state.items() if v[0] > now and k[0] in self.ttls)
+
+
+    def collect(self):
+        '''Yields metrics on the use of the cache'''
+
+        with self.lock:
+          hits = dict(self.hits)
+          misses = dict(self.misses)
+          evictions = dict(self.evictions)
+          no_of_entries = len(self.entries)
+
+        for name, desc, counter in [
+          ('workbook_cache_hits', 'Calls to Workbook answered from the cache', hits),
+          ('workbook_cache_misses', 'Calls to Workbook not found in the cache', misses),
+          ('workbook_cache_evictions', 'Entries evicted from the cache to make room', evictions)
+          ]:
+          c = CounterMetricFamily(name, desc, labels=['endpoint'])
+          for endpoint in sorted(self.ttls.keys()):
+            c.add_metric([endpoint], counter.get(endpoint, 0))
+          yield c
+
+        g = GaugeMetricFamily(
+          'workbook_cache_entries', 'Number of entries in the cache')
+        g.add_metric([], no_of_entries)
+        yield g
+
+
+def is_retryable(e):
+    '''Returns True if a request to Workbook failing with exception e
+    may succeed if made again'''
+
+    # Workbook overloaded or failing
+    if isinstance(e, workbook_api.UnexpectedStatusCode):
+      m = re.search(r'Got (\d+)', str(e))
+      return bool(m) and (int(m.group(1)) >= 500 or int(m.group(1)) == 429)
+
+    # Connections failing, timing out or closing during the response.
+    # Not errors in the request, like a bad URL, or in the data returned.
+    retryable = (requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+      requests.exceptions.ChunkedEncodingError, asyncio.TimeoutError, ConnectionError)
+    if aiohttp:
+      retryable += (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError)
+    return isinstance(e, retryable)
+
+
+class TimeoutHTTPAdapter(requests.adapters.HTTPAdapter):
+    '''An HTTPAdapter giving requests made without a timeout the timeout
+    set here, so requests to Workbook made by workbook_api can not hang
+    forever. Like the timeouts of the asyncio engine, it limits the
+    seconds to connect, and the seconds between data received.
+
+    Keyword arguments:
+    timeout (Float): Seconds to use as timeout. None for no timeout.
+    '''
+
+    def __init__(self, timeout=None, **kwargs):
+        self.timeout = timeout
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        if kwargs.get('timeout') is None:
+          kwargs['timeout'] = self.timeout
+        return super().send(request, **kwargs)
+
+
+class RateLimiter(object):
+    '''Limits the requests made to Workbook using a token bucket, and the
+    number of requests in flight. Requests failing in a way that may not
+    happen again, are retried with exponential backoff and jitter.
+
+    If target_latency and rate are set, the rate adapts to how fast Workbook
+    answers. It is halved when a request takes longer (Down to min_rate),
+    and raised by a 20th of the max rate when not.
+
+    Keyword arguments:
+    rate (Float): Max requests pr. second. 0 for no limit.
+    burst (Int): Max requests at once after a quiet period
+    max_concurrent (Int): Max requests in flight. 0 for no limit.
+    retries (Int): Times to retry a failed request
+    backoff (Float): Max seconds to wait before the first retry. Doubles for every retry.
+    max_backoff (Float): Max seconds to wait before any retry
+    target_latency (Float): Seconds a request may take before lowering the rate. 0 disables.
+    min_rate (Float): Never lower the rate below this
+    '''
+
+    def __init__(self, rate=0, burst=1, max_concurrent=0, retries=2,
+        backoff=0.5, max_backoff=30, target_latency=0, min_rate=0.1):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.target_latency = target_latency
+        self.min_rate = min(min_rate, rate) if rate else min_rate
+
+        # The rate currently allowed
+        self.current_rate = rate
+
+        # Tokens in the bucket. Negative if requests are waiting.
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+        # Limits the requests in flight. None for no limit.
+        self.semaphore = threading.BoundedSemaphore(max_concurrent) \
+          if max_concurrent else None
+
+        # Threads waiting for the semaphore for event loops. The semaphore
+        # is shared with threads, and event loops in other threads.
+        self.acquire_pool = concurrent.futures.ThreadPoolExecutor(
+          max_workers=max_concurrent, thread_name_prefix='rate_limiter') \
+          if max_concurrent else None
+
+        # Seconds waited for the rate limit, and retries pr. call name
+        self.wait_seconds = 0
+        self.retry_counts = collections.Counter()
+
+        # Protects the attributes above
+        self.lock = threading.Lock()
+
+
+    def reserve(self):
+        '''Take a token from the bucket. Returns seconds to wait before
+        making the request'''
+        with self.lock:
+          if not self.current_rate:
+            return 0
+
+          # Add the tokens for the time since last update
+          now = time.monotonic()
+          self.tokens = min(self.burst,
+            self.tokens + (now - self.updated) * self.current_rate)
+          self.updated = now
+
+          self.tokens -= 1
+          if self.tokens >= 0:
+            return 0
+
+          wait = -self.tokens / self.current_rate
+          self.wait_seconds += wait
+          return wait
+
+
+    def observe(self, latency):
+        '''Adapt the rate to a request taking latency seconds'''
+        if not self.target_latency or not self.rate:
+          return
+        with self.lock:
+          if latency > self.target_latency:
+            self.current_rate = max(self.min_rate, self.current_rate / 2)
+          else:
+            self.current_rate = min(self.rate, self.current_rate + self.rate / 20)
+
+
+    def retry_delay(self, name, attempt, e):
+        '''Returns seconds to wait before retrying call name failing with
+        exception e, or None if the call is not to be retried'''
+        if attempt >= self.retries or not is_retryable(e):
+          return None
+
+        with self.lock:
+          self.retry_counts[name] += 1
+
+        delay = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+        logging.warning("Call {} to Workbook failed with error: {}. Retrying in {:.1f} seconds"
+          .format(name, e, delay))
+        return delay
+
+
+    def call(self, name, func):
+        '''Returns func(), called when allowed, and retried if failing'''
+        attempt = 0
+        while True:
+          time.sleep(self.reserve())
+          if self.semaphore:
+            self.semaphore.acquire()
+          start_time = time.monotonic()
+          try:
+            data = func()
+          except Exception as e:
+            delay = self.retry_delay(name, attempt, e)
+            if delay is None:
+              raise
+          else:
+            self.observe(time.monotonic() - start_time)
+            return data
+          finally:
+            if self.semaphore:
+              self.semaphore.release()
+
+          attempt += 1
+          time.sleep(delay)
+
+
+    async def call_async(self, name, func):
+        '''Returns the result of awaiting func(), made when allowed, and
+        retried if failing'''
+        attempt = 0
+        while True:
+          await asyncio.sleep(self.reserve())
+          if self.semaphore:
+            await self.acquire_async()
+          start_time = time.monotonic()
+          try:
+            data = await func()
+          except Exception as e:
+            delay = self.retry_delay(name, attempt, e)
+            if delay is None:
+              raise
+          else:
+            self.observe(time.monotonic() - start_time)
+            return data
+          finally:
+            if self.semaphore:
+              self.semaphore.release()
+
+          attempt += 1
+          await asyncio.sleep(delay)
+
+
+    async def acquire_async(self):
+        '''Acquire the semaphore without blocking the event loop'''
+        if self.semaphore.acquire(blocking=False):
+          return
+
+        # Wait in a thread of the pool
+        acquiring = self.acquire_pool.submit(self.semaphore.acquire)
+        try:
+          await asyncio.wrap_future(acquiring)
+        except asyncio.CancelledError:
+          # Give the semaphore back, if acquired after giving up
+          acquiring.add_done_callback(
+            lambda f: f.cancelled() or self.semaphore.release())
+          raise
+
+
+    def collect(self):
+        '''Yields metrics on the rate limiting and retries'''
+
+        with self.lock:
+          wait_seconds = self.wait_seconds
+          retry_counts = dict(self.retry_counts)
+          current_rate = self.current_rate
+
+        c = CounterMetricFamily(
+          'workbook_rate_limiter_wait_seconds',
+          'Seconds requests to Workbook waited for the rate limit')
+        c.add_metric([], wait_seconds)
+        yield c
+
+        g = GaugeMetricFamily(
+          'workbook_rate_limiter_rate',
+          'Requests pr. second currently allowed to Workbook. 0 for no limit')
+        g.add_metric([], current_rate)
+        yield g
+
+        c = CounterMetricFamily(
+          'workbook_request_retries',
+          'Requests to Workbook retried after failing', labels=['endpoint'])
+        for endpoint in sorted(retry_counts.keys()):
+          c.add_metric([endpoint], retry_counts[endpoint])
+        yield c
+
+
+class RequestStats(object):
+    '''Latency, size and errors of requests made to Workbook, pr. endpoint
+    (The name of the call). Every attempt at a request is counted.
+
+    The bytes of a response are added by whoever reads it (See
+    response_hook()), to the endpoint of the call in progress in the
+    current thread or task.
+
+    Keyword arguments:
+    buckets (List): Upper bounds (Seconds) of the latency histogram buckets
+    '''
+
+    def __init__(self, buckets=[0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]):
+        self.buckets = buckets
+
+        # HistogramBins of latencies, and counts pr. endpoint
+        self.latencies = {}
+        self.items = collections.Counter()
+        self.bytes = collections.Counter()
+        self.errors = collections.Counter()
+
+        # The endpoint of the call in progress
+        self.endpoint = contextvars.ContextVar('endpoint', default=None)
+
+        # Protects the attributes above
+        self.lock = threading.Lock()
+
+
+    def observe(self, name, latency, data=None, error=False):
+        '''Add a request to endpoint name taking latency seconds, and
+        returning data'''
+        with self.lock:
+          if name not in self.latencies:
+            self.latencies[name] = HistogramBins(self.buckets)
+          self.latencies[name].update([latency])
+          if error:
+            self.errors[name] += 1
+          elif isinstance(data, list):
+            self.items[name] += len(data)
+          elif data is not None:
+            self.items[name] += 1
+
+
+    def add_bytes(self, size):
+        '''Add size bytes read to the endpoint of the call in progress'''
+        name = self.endpoint.get()
+        if name is None:
+          return
+        with self.lock:
+          self.bytes[name] += size
+
+
+    def response_hook(self, r, *args, **kwargs):
+        '''Response hook for a requests session, adding the bytes read'''
+        self.add_bytes(len(r.content))
+
+
+    def call(self, name, func):
+        '''Returns func(), measured as a request to endpoint name'''
+        token = self.endpoint.set(name)
+        start_time = time.monotonic()
+        try:
+          data = func()
+        except Exception:
+          self.observe(name, time.monotonic() - start_time, error=True)
+          raise
+        finally:
+          self.endpoint.reset(token)
+        self.observe(name, time.monotonic() - start_time, data)
+        return data
+
+
+    async def call_async(self, name, func):
+        '''Returns the result of awaiting func(), measured as a request to
+        endpoint name'''
+        token = self.endpoint.set(name)
+        start_time = time.monotonic()
+        try:
+          data = await func()
+        except Exception:
+          self.observe(name, time.monotonic() - start_time, error=True)
+          raise
+        finally:
+          self.endpoint.reset(token)
+        self.observe(name, time.monotonic() - start_time, data)
+        return data
+
+
+    def collect(self):
+        '''Yields metrics on the requests made to Workbook'''
+
+        with self.lock:
+          latencies = {n: (h.buckets_list(), h.sum)
+            for n, h in self.latencies.items()}
+          items = dict(self.items)
+          size = dict(self.bytes)
+          errors = dict(self.errors)
+
+        h = HistogramMetricFamily(
+          'workbook_request_duration_seconds',
+          'Seconds requests to Workbook took', labels=['endpoint'])
+        for endpoint in sorted(latencies.keys()):
+          buckets, sum_value = latencies[endpoint]
+          h.add_metric([endpoint], buckets, sum_value)
+        yield h
+
+        c = CounterMetricFamily(
+          'workbook_request_items',
+          'Items returned by requests to Workbook', labels=['endpoint'])
+        for endpoint in sorted(items.keys()):
+          c.add_metric([endpoint], items[endpoint])
+        yield c
+
+        c = CounterMetricFamily(
+          'workbook_request_bytes',
+          'Bytes returned by requests to Workbook', labels=['endpoint'])
+        for endpoint in sorted(size.keys()):
+          c.add_metric([endpoint], size[endpoint])
+        yield c
+
+        c = CounterMetricFamily(
+          'workbook_request_errors',
+          'Requests to Workbook failing', labels=['endpoint'])
+        for endpoint in sorted(errors.keys()):
+          c.add_metric([endpoint], errors[endpoint])
+        yield c
+
+
+class ScrapeMemo(object):
+    '''Data returned by calls to Workbook during a single collection.
+    Makes sure the same call, with the same arguments, is made at most
+    once pr. collection. Callers get the same data, which must not be
+    modified.
+    '''
+
+    def __init__(self):
+        # Keys are (call name, args, kwargs). Values are futures with the data
+        self.futures = {}
+
+        # Protects the futures
+        self.lock = threading.Lock()
+
+
+    def _future(self, key):
+        '''Returns (future, True) if the caller must make the call,
+        or (future, False) if the call is made by someone else'''
+        with self.lock:
+          if key in self.futures:
+            return self.futures[key], False
+          f = self.futures[key] = concurrent.futures.Future()
+          return f, True
+
+
+    def call(self, key, func):
+        '''Returns the data from func(), or from an earlier call with key'''
+        f, owner = self._future(key)
+        if owner:
+          try:
+            f.set_result(func())
+          except Exception as e:
+            f.set_exception(e)
+        return f.result()
+
+
+    async def call_async(self, key, func):
+        '''Returns the data from awaiting func(), or from an earlier call with key'''
+        f, owner = self._future(key)
+        if owner:
+          try:
+            f.set_result(await func())
+          except Exception as e:
+            f.set_exception(e)
+        return await asyncio.wrap_future(f)
+
+
+class CachedWorkbookAPI(object):
+    '''Wraps a WorkbookAPI (Or AsyncWorkbookAPI) object. Calls already made
+    during the current collection are answered from the ScrapeMemo, if set.
+    Calls configured in the TTLCache are answered from the cache if
+    possible. Requests actually made to Workbook go through the
+    RateLimiter, if set, and are counted. Every attempt is measured by
+    the RequestStats, if set.
+    '''
+
+    # Calls with data reduced to sums once it has been read. Not kept
+    # in the memo, so the data can be freed once it has been used.
+    # Only time entries (by date), jobs and debtors (pr. company) are
+    # fetched in parts. Creditors and prices are read in one response.
+    STREAMED = {
+      'get_creditors',
+      'get_debtors_balance',
+      'get_employee_prices_hour',
+      'get_jobs',
+      'get_time_entries',
+      }
+
+    def __init__(self, wb, cache, memo=None, limiter=None, stats=None):
+        # The wrapped Workbook API object
+        self.wb = wb
+
+        # Limits and retries requests to Workbook. None disables.
+        self.limiter = limiter
+
+        # Measures requests to Workbook. None disables.
+        self.stats = stats
+
+        # The cache to use
+        self.cache = cache
+
+        # Data from the current collection. None disables.
+        self.memo = memo
+
+        # How many requests were made to workbook? Counted by
+        # the threads of the pool, so protected by the lock.
+        self.no_of_requests = 0
+        self.lock = threading.Lock()
+
+
+    def count_request(self, n=1):
+        '''Count n requests made to Workbook'''
+        with self.lock:
+          self.no_of_requests += n
+
+
+    def __getattr__(self, name):
+        func = getattr(self.wb, name)
+
+        # Only wrap calls to Workbook
+        if not name.startswith('get_'):
+          return func
+
+        if asyncio.iscoroutinefunction(func):
+          async def fetch_async(key, args, kwargs):
+            if name in self.cache.ttls:
+              found, data = self.cache.get(key)
+              if found:
+                return data
+            self.count_request()
+            request = lambda: func(*args, **kwargs)
+            if self.stats:
+              request = functools.partial(self.stats.call_async, name, request)
+            if self.limiter:
+              data = await self.limiter.call_async(name, request)
+            else:
+              data = await request()
+            if name in self.cache.ttls:
+              self.cache.set(key, data)
+            return data
+
+          @functools.wraps(func)
+          async def call_async(*args, **kwargs):
+            key = (name, freeze(args), freeze(kwargs))
+            if self.memo is None or name in self.STREAMED:
+              return await fetch_async(key, args, kwargs)
+            return await self.memo.call_async(
+              key, lambda: fetch_async(key, args, kwargs))
+          return call_async
+
+        def fetch(key, args, kwargs):
+          if name in self.cache.ttls:
+            found, data = self.cache.get(key)
+            if found:
+              return data
+          self.count_request()
+          request = lambda: func(*args, **kwargs)
+          if self.stats:
+            request = functools.partial(self.stats.call, name, request)
+          if self.limiter:
+            data = self.limiter.call(name, request)
+          else:
+            data = request()
+          if name in self.cache.ttls:
+            self.cache.set(key, data)
+          return data
+
+        @functools.wraps(func)
+        def call(*args, **kwargs):
+          key = (name, freeze(args), freeze(kwargs))
+          if self.memo is None or name in self.STREAMED:
+            return fetch(key, args, kwargs)
+          return self.memo.call(key, lambda: fetch(key, args, kwargs))
+        return call
+
+
+class TimeEntryStore(object):
+    '''Time entries for the last number of days, with sums pr. company and
+    department kept up to date as entries are added and removed.
+
+    In incremental mode, only entries since the last sync (Minus overlap
+    seconds) are fetched from Workbook. All entries in the window are
+    fetched on the first sync, and every full_sync_interval seconds,
+    to catch entries registered late, and employees changing department.
+    Entries are replaced by the date of the work, which is not among the
+    fields documented by workbook_api. If a sync gets entries without it,
+    incremental mode is turned off.
+
+    Time entries are fetched page_days at a time, and each page is added
+    to the sums before the next is fetched. Only incremental mode keeps
+    (a small record of) each entry.
+    '''
+
+    def __init__(self, days=7, incremental=False, overlap=86400,
+        full_sync_interval=21600, page_days=1):
+        # Days to look in to the past for time entries
+        self.days = days
+
+        # Only fetch time entries since last sync?
+        self.incremental = incremental
+
+        # Seconds before the last sync to fetch time entries from
+        self.overlap = overlap
+
+        # Seconds between fetching all time entries in the window
+        self.full_sync_interval = full_sync_interval
+
+        # Days of time entries to get pr. request to Workbook
+        self.page_days = page_days
+
+        # Time entry IDs as keys. Values are (date of work, contribution)
+        self.entries = {}
+
+        # Sums with (company_id, department_id) as keys
+        self.aggregates = {}
+
+        # Time of last sync, and last sync of the full window
+        self.last_sync = None
+        self.last_full_sync = None
+
+        # Protects the attributes above
+        self.lock = threading.Lock()
+
+        # Held during a sync, so syncs do not overlap
+        self.sync_lock = threading.Lock()
+
+
+    @staticmethod
+    def contribution(e, employees, jobs, prices):
+        '''Returns what time entry e adds to the sums of its department, or
+        None if the entry is not to be counted'''
+
+        # Sometimes a resource is no longer an employee
+        employee = employees.get(e['ResourceId'])
+        if not employee:
+          return None
+
+        # Get hours in current time entry (If any)
+        h = e.get('Hours', 0)
+
+        billable = 0
+        revenue = 0
+        if e.get('Billable'):
+          billable = h
+          # Calculate revenue, if we have prices for employee
+          p = prices.get(e['ResourceId'])
+          if p and p.hours_sale is not None:
+            revenue = h * p.hours_sale
+          else:
+            logging.error("Error while calculating revenue: No sales price for resource {}"
+              .format(e['ResourceId']))
+
+        j_id = e['JobId']
+        customer_id = jobs[j_id].customer_id if jobs.get(j_id) else None
+
+        return (
+          (employee.company_id, employee.department_id),
+          h, billable, revenue, e['ResourceId'], j_id, customer_id
+          )
+
+
+    @staticmethod
+    def apply(aggregates, contribution, sign):
+        '''Add (sign 1) or remove (sign -1) a contribution to the sums
+        in aggregates'''
+
+        key, h, billable, revenue, resource_id, job_id, customer_id = contribution
+
+        a = aggregates.get(key)
+        if not a:
+          a = aggregates[key] = {
+            'billable': 0,
+            'total': 0,
+            'revenue': 0,
+            'resource_ids': collections.Counter(),
+            'job_ids': collections.Counter(),
+            'customer_ids': collections.Counter()
+            }
+
+        a['billable'] += sign * billable
+        a['total'] += sign * h
+        a['revenue'] += sign * revenue
+
+        # Count references to IDs, so they can be removed again
+        for field, i in [
+          ('resource_ids', resource_id),
+          ('job_ids', job_id),
+          ('customer_ids', customer_id)]:
+          if i is None:
+            continue
+          a[field][i] += sign
+          if a[field][i] <= 0:
+            del a[field][i]
+
+
+    def periods(self, start, end):
+        '''Yields keyword arguments for getting time entries between start
+        and end from Workbook, page_days of time entries at a time'''
+        page_start = start
+        while page_start < end:
+          page_end = min(end, page_start + timedelta(days=self.page_days))
+          # Time period to get time entries for (Time where work was done)
+          yield {
+            'Start': page_start.isoformat(),
+            'End': page_end.isoformat(),
+            'HasTimeRegistration': True
+            }
+          page_start = page_end
+
+
+    def sync(self, wb, employees, jobs, prices):
+        '''Get new time entries from Workbook and update the sums.
+        Raises an exception if the time entries could not be had, in
+        which case the entries and sums are left as they were.
+
+        The new entries and sums are built on their own, and replace
+        the ones kept when all pages are had, so readers never see
+        sums half done. Only one sync runs at a time.
+        '''
+
+        with self.sync_lock:
+          sync = self.start_sync()
+          for kwargs in self.periods(sync['start'], sync['now']):
+            self.add_page(sync, wb.get_time_entries(**kwargs), employees, jobs, prices)
+          self.finish_sync(sync)
+
+
+    async def sync_async(self, wb, employees, jobs, prices):
+        '''Like sync(), getting time entries with the coroutines of wb
+        (Like an AsyncWorkbookAPI). Waits for other syncs blocking the
+        event loop, so run it in a loop of its own.'''
+
+        with self.sync_lock:
+          sync = self.start_sync()
+          for kwargs in self.periods(sync['start'], sync['now']):
+            self.add_page(sync, await wb.get_time_entries(**kwargs), employees, jobs, prices)
+          self.finish_sync(sync)
+
+
+    def start_sync(self):
+        '''Returns a dict with the period to get time entries for, and
+        the entries and sums to build on. Call with sync_lock held.'''
+
+        now = datetime.today()
+        window_start = now - timedelta(days=self.days)
+
+        with self.lock:
+          # Get all time entries in the window?
+          full = not self.incremental or \
+            not self.last_full_sync or \
+            (now - self.last_full_sync).total_seconds() >= self.full_sync_interval
+
+          if full:
+            start = window_start
+            entries = {}
+            aggregates = {}
+          else:
+            start = max(window_start, self.last_sync - timedelta(seconds=self.overlap))
+            entries = dict(self.entries)
+            aggregates = copy.deepcopy(self.aggregates)
+
+        # Entries in the period fetched are replaced by the ones
+        # returned. Entries out of the window are evicted.
+        if not full:
+          for e_id, (date, c) in list(entries.items()):
+            if date >= start or date < window_start:
+              del entries[e_id]
+              if c:
+                self.apply(aggregates, c, -1)
+
+        return {
+          'now': now,
+          'start': start,
+          'full': full,
+          'entries': entries,
+          'aggregates': aggregates,
+          # IDs of entries seen, if the entries are not kept
+          'seen': set(),
+          # Entries without a usable date
+          'no_of_undated': 0,
+          'no_of_time_entries': 0
+          }
+
+
+    def add_page(self, sync, time_entries, employees, jobs, prices):
+        '''Add a page of time entries to the entries and sums of sync'''
+
+        entries = sync['entries']
+        aggregates = sync['aggregates']
+        seen = sync['seen']
+
+        for e in time_entries:
+          # Pages may overlap
+          if e['Id'] in seen:
+            continue
+
+          # Replace entry if seen before
+          if e['Id'] in entries:
+            _, c = entries.pop(e['Id'])
+            if c:
+              self.apply(aggregates, c, -1)
+
+          c = self.contribution(e, employees, jobs, prices)
+          if c:
+            self.apply(aggregates, c, 1)
+
+          date = None
+          if self.incremental:
+            try:
+              date = parse_date(e[TIME_ENTRY_DATE_FIELD])
+            except (KeyError, TypeError, ValueError):
+              sync['no_of_undated'] += 1
+
+          if date:
+            entries[e['Id']] = (date, c)
+          else:
+            seen.add(e['Id'])
+
+        sync['no_of_time_entries'] += len(time_entries)
+
+
+    def finish_sync(self, sync):
+        '''Replace the entries and sums kept by the ones built in sync'''
+
+        entries = sync['entries']
+        no_of_undated = sync['no_of_undated']
+
+        # Entries without a date can not be replaced by the date of
+        # the work, so incremental mode is turned off for good
+        if no_of_undated:
+          logging.error(("{} time entries have no usable '{}' field. Turning off" +
+            " incremental sync of time entries").format(no_of_undated, TIME_ENTRY_DATE_FIELD))
+          entries = {}
+
+        with self.lock:
+          self.entries = entries
+          self.aggregates = sync['aggregates']
+          self.last_sync = sync['now']
+          if sync['full']:
+            self.last_full_sync = sync['now']
+          if no_of_undated:
+            self.incremental = False
+
+        logging.debug("Got {} time entries since {}. Holding {} time entries"
+          .format(sync['no_of_time_entries'], sync['start'], len(entries)))
+
+
+    def get_state(self):
+        '''Returns the time entries and sums, for saving to disk'''
+        with self.lock:
+          return {
+            'entries': dict(self.entries),
+            'aggregates': copy.deepcopy(self.aggregates),
+            'last_sync': self.last_sync,
+            'last_full_sync': self.last_full_sync,
+            'incremental': self.incremental
+            }
+
+
+    def set_state(self, state):
+        '''Restore time entries and sums returned by get_state(). The sums
+        are only restored if they were saved in the same mode (Incremental
+        or not), and with the entries needed for incremental syncs.
+        Otherwise, the next sync gets all time entries.'''
+        with self.lock:
+          self.entries = state['entries']
+          self.aggregates = state['aggregates']
+          self.last_sync = state['last_sync']
+          self.last_full_sync = state['last_full_sync']
+
+          # Not in states saved before the mode was saved. Entries
+          # without a date can not be synced incrementally.
+          if state.get('incremental') != self.incremental or \
+            (self.incremental and not self.entries) or \
+            any(date is None for date, c in self.entries.values()):
+            logging.info("Not restoring sums of time entries saved in another mode")
+            self.entries = {}
+            self.aggregates = {}
+            self.last_full_sync = None
+
+
+    def get_aggregates(self):
+        '''Returns a copy of the sums pr. (company_id, department_id)'''
+        with self.lock:
+          return copy.deepcopy(self.aggregates)
+
+
+def shard_data(data, keys):
+    '''Returns a dict with company IDs as keys, and the part of data (From
+    get_data()) concerning the company as values. Only the keys in keys
+    are included. Data not split by company (Like currencies and
+    departments) is included whole in every part.
+
+    Keyword arguments:
+    data (Dict): Data from get_data(), including companies
+    keys (Iterable): The keys of the data to include
+    '''
+
+    companies = data['companies']
+    shards = {c_id:{'companies': {c_id: c}} for c_id, c in companies.items()}
+
+    for k in keys:
+      if k == 'companies':
+        continue
+      value = data[k]
+
+      if k == 'accounts':
+        for shard in shards.values():
+          shard[k] = []
+        for a in value:
+          if a['CompanyId'] in shards:
+            shards[a['CompanyId']][k].append(a)
+
+      elif k in ['employees', 'jobs']:
+        for shard in shards.values():
+          shard[k] = {}
+        for i, r in value.items():
+          if r.company_id in shards:
+            shards[r.company_id][k][i] = r
+
+      elif k == 'prices' and 'employees' in data:
+        # Prices are for employees
+        employees = data['employees']
+        for shard in shards.values():
+          shard[k] = {}
+        for e_id, p in value.items():
+          e = employees.get(e_id)
+          if e and e.company_id in shards:
+            shards[e.company_id][k][e_id] = p
+
+      elif k == 'customers' and 'jobs' in data:
+        # Customers with jobs in the company
+        for shard in shards.values():
+          shard[k] = {}
+        for j in data['jobs'].values():
+          if j.company_id in shards and j.customer_id in value:
+            shards[j.company_id][k][j.customer_id] = value[j.customer_id]
+
+      elif k == 'creditors':
+        # Observations pr. company
+        for c_id, shard in shards.items():
+          shard[k] = {c_id: value[c_id]} if c_id in value else {}
+
+      else:
+        for shard in shards.values():
+          shard[k] = value
+
+    return shards
+
+
+class WorkbookCollector(object):
+
+    # Sections of metrics, in the order they are collected, with
+    # the data from get_data() used by each section
+    SECTIONS = {
+      'finance_accounts': ['currencies', 'companies', 'accounts'],
+      'time_entries': ['currencies', 'companies', 'departments', 'employees',
+        'capacity_profiles', 'jobs', 'prices'],
+      'employee_prices': ['currencies', 'companies', 'departments',
+        'employees', 'prices'],
+      'employees': ['companies', 'employees'],
+      'jobs': ['companies', 'jobs', 'customers'],
+      'credit': ['currencies', 'companies', 'creditors'],
+      'debit': ['currencies', 'companies'],
+      }
+
+    # Sections folding in data from Workbook as it arrives, instead
+    # of using data from get_data() only. Collected every time.
+    STREAMING_SECTIONS = {'time_entries', 'debit'}
+
+    # Sections with metrics pr. company, which can be collected
+    # from the data of every company on its own
+    SHARDED_SECTIONS = {'finance_accounts', 'employee_prices', 'employees',
+      'jobs', 'credit'}
+
+    # Data returned by get_data(), with the data it is derived from
+    DATA_DEPENDENCIES = {
+      'currencies': [],
+      'companies': [],
+      'employees': ['companies'],
+      'capacity_profiles': ['employees'],
+      'departments': [],
+      'jobs': ['companies'],
+      'customers': ['jobs'],
+      'creditors': [],
+      'prices': [],
+      'accounts': ['companies'],
+      }
+
+    def __init__(self, wb_url, wb_user, wb_pass, workers=1, request_timeout=None,
+        engine='threads', cache_ttls={}, cache_max_entries=10000,
+        time_entries_incremental=False, time_entries_overlap=86400,
+        time_entries_full_sync_interval=21600, time_entries_page_days=1,
+        companies=[], active_jobs=[0,1,2,3], finance_account_types=[3],
+        limiter=None, aggregation_processes=0, changes=None):
+        # Only get data on these companies. If empty list,
+        # get data for all companies in Workbook
+        self.companies_to_get = companies
+
+        # Jobs with these states are considered active
+        self.active_jobs = active_jobs
+
+        # Types of finance accounts to report balances for
+        self.finance_account_types = finance_account_types
+
+        # Cache of data from Workbook shared by all collections
+        self.cache = TTLCache(cache_ttls, cache_max_entries)
+
+        # Rate limit and retries of requests shared by all collections
+        self.limiter = limiter if limiter else RateLimiter()
+
+        # Latency, size and errors of requests shared by all collections
+        self.stats = RequestStats()
+
+        # Workbook API object
+        self.wb = CachedWorkbookAPI(
+          workbook_api.WorkbookAPI(wb_url, wb_user, wb_pass), self.cache,
+          limiter=self.limiter, stats=self.stats)
+
+        # Credentials for the asyncio engine, which makes its own requests
+        self.wb_url = wb_url
+        self.wb_user = wb_user
+        self.wb_pass = wb_pass
+
+        # Get data using the pool of threads ('threads') or an event loop ('asyncio')
+        self.engine = engine
+
+        # Allow a connection to Workbook for every worker, and time
+        # out requests taking more than request_timeout seconds
+        adapter = TimeoutHTTPAdapter(
+          timeout=request_timeout, pool_maxsize=max(10, workers))
+        self.wb.session.mount('https://', adapter)
+        self.wb.session.mount('http://', adapter)
+
+        # Count the bytes of every response
+        self.wb.session.hooks['response'].append(self.stats.response_hook)
+
+        # Pool of threads for calling Workbook in parallel
+        self.workers = workers
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+
+        # Max seconds to wait for Workbook to connect, or send data
+        self.request_timeout = request_timeout
+
+        # Number of processes collecting the sections in SHARDED_SECTIONS
+        # pr. company. If 0, sections are collected in this process.
+        # The pool is started on first use.
+        self.aggregation_processes = aggregation_processes
+        self.process_pool = None
+        self.process_pool_lock = threading.Lock()
+
+        # Queue of records logged in the pool of processes, and the
+        # thread handling them. Started with the pool.
+        self.log_queue = None
+        self.log_listener = None
+
+        # Publishes the series changed by every collection. None disables.
+        self.changes = changes
+
+        # Time entries for the last 7 days, kept between collections
+        self.time_entries = TimeEntryStore(
+          days=7,
+          incremental=time_entries_incremental,
+          overlap=time_entries_overlap,
+          full_sync_interval=time_entries_full_sync_interval,
+          page_days=time_entries_page_days)
+
+        # Metrics of the last successful collection of every section,
+        # served when a collection of the section fails
+        self.last_good = {}
+
+        # Digests of the data the last good metrics were collected
+        # from, and the number of times they were reused pr. section
+        self.digests = {}
+        self.no_of_unchanged = collections.Counter()
+
+
+    def fan_out(self, func, items):
+        '''Call func(item) for all items using the pool of workers
+
+        Returns a dict with the items as keys and the returned data as
+        values. Items where func fails (Like requests timing out after
+        request_timeout seconds), are logged and left out of the dict.
+
+        Keyword arguments:
+        func (Function): The function to call with every item
+        items (Iterable): The items to call func with
+        '''
+
+        futures = {i:self.pool.submit(func, i) for i in items}
+
+        results = {}
+        for i, f in futures.items():
+          try:
+            results[i] = f.result()
+          except Exception as e:
+            logging.error("Call {}({}) to Workbook failed with error: {}"
+              .format(func.__name__, i, e))
+
+        return results
+
+
+    def data_keys(self, sections):
+        '''Returns the set of keys in the data from get_data() needed
+        for collecting sections, including the data they depend on'''
+        keys = set()
+        needed = [k for s in sections for k in self.SECTIONS[s]]
+        while needed:
+          k = needed.pop()
+          if k not in keys:
+            keys.add(k)
+            needed.extend(self.DATA_DEPENDENCIES[k])
+        return keys
+
+
+    def get_data(self, wb, keys):
+        '''Get the data needed by the metrics from Workbook
+
+        Returns a dict with the data. Data which could not be had, or
+        depends on data which could not be had, is left out.
+
+        Keyword arguments:
+        wb (CachedWorkbookAPI): Workbook API to use for this collection
+        keys (Set): The data to get (Keys in DATA_DEPENDENCIES)
+        '''
+
+        data = {}
+
+        def get_currencies():
+          # A dictionary mapping id to ISO name
+          return {c['Id']:c['Iso4127'] for c in wb.get_currencies()}
+
+        def get_companies():
+          # A dictionary mapping id to company name
+          companies = filter_companies(
+            {c['Id']:c for c in wb.get_companies(active=True)},
+            self.companies_to_get)
+
+          # Get full company info from WB
+          companies_info = self.fan_out(
+            lambda c_id: wb.get_company(CompanyId=c_id), companies.keys())
+
+          # We can not report on companies without a currency
+          if len(companies_info) != len(companies):
+            raise Exception("Could not get info on all companies")
+
+          # Add currency_id to companies
+          for c_id, c_data in companies.items():
+            # Add currency to company dict
+            c_data['CurrencyId'] = companies_info[c_id]['CurrencyID']
+
+          return companies
+
+        def get_employees():
+          # A dictionary mapping IDs to employees
+          employees = {}
+          # Get employees for all companies
+          for c_id in data['companies'].keys():
+            for e in wb.get_employees(Active=True, CompanyId=c_id):
+              employees[e['Id']] = Employee.from_wb(e)
+
+          return employees
+
+        def get_capacity_profiles():
+          # Capacity profiles (Hours pr/week for employees)
+          # Employee ID is key
+          capacity_profiles = {}
+
+          # Get all profiles for all employees. Employees
+          # failing are left out
+          employees_profiles = self.fan_out(
+            wb.get_capacity_profiles, data['employees'].keys())
+
+          for e_id, profiles in employees_profiles.items():
+            capacity_profiles[e_id] = pick_capacity_profile(
+              profiles, data['employees'][e_id])
+
+          return capacity_profiles
+
+        def get_departments():
+          # A dictionary mapping IDs to departments
+          return {d['Id']:Department.from_wb(d) for d in wb.get_departments()}
+
+        def get_jobs():
+          # A dictionary mapping Job IDs to jobs
+          jobs = {}
+          # Get jobs for all companies
+          for c_id in data['companies'].keys():
+            for j in wb.get_jobs(Status=self.active_jobs,CompanyId=c_id):
+              jobs[j['Id']] = Job.from_wb(j, company_id=c_id)
+
+          return jobs
+
+        def get_customers():
+          # A dictionary mapping IDs to customers with active jobs
+          return self.get_customers(
+            wb, {j.customer_id for j in data['jobs'].values()})
+
+        def get_creditors():
+          # Amounts owed to creditors pr. company. Workbook can't filter
+          # creditors, so the whole list is read before it is reduced
+          return creditor_observations(
+            Creditor.from_wb(c) for c in wb.get_creditors())
+
+        def get_prices():
+          # Current employee prices
+          return current_prices(Price.from_wb(p) for p in \
+            wb.get_employee_prices_hour(ActiveEmployees=True))
+
+        def get_accounts():
+          # Get a list of finance accounts
+          accounts = wb.get_finance_accounts(
+            TypeIds=self.finance_account_types,
+            Companies=data['companies'].keys())
+
+          # Get balances for all accounts. Accounts failing
+          # are left out, and will not be reported.
+          balances = self.fan_out(
+            lambda i: wb.get_finance_account_balance(
+              CompanyId=accounts[i]['CompanyId'],
+              AccountId=accounts[i]['Id'],
+              ),
+            range(len(accounts))
+            )
+
+          # Add balance to accounts
+          for i, balance_list in balances.items():
+            add_account_balance(accounts[i], balance_list)
+
+          return accounts
+
+        getters = {
+          'currencies': get_currencies,
+          'companies': get_companies,
+          'employees': get_employees,
+          'capacity_profiles': get_capacity_profiles,
+          'departments': get_departments,
+          'jobs': get_jobs,
+          'customers': get_customers,
+          'creditors': get_creditors,
+          'prices': get_prices,
+          'accounts': get_accounts
+          }
+
+        # Data is listed after the data it depends on
+        for k in self.DATA_DEPENDENCIES.keys():
+          if k not in keys:
+            continue
+          if not all(d in data for d in self.DATA_DEPENDENCIES[k]):
+            logging.debug("Not getting {}, because data it depends on is missing".format(k))
+            continue
+          try:
+            data[k] = getters[k]()
+          except Exception as e:
+            logging.error("Could not get {} from Workbook: {}".format(k, e))
+
+        return data
+
+
+    def get_customers(self, wb, customer_ids):
+        '''Returns a dict mapping IDs to customers for customer_ids
+
+        All customers are fetched from Workbook in a single request.
+        Customers not in there are fetched one by one. Customers
+        which could not be had are left out.
+
+        Keyword arguments:
+        wb (CachedWorkbookAPI): Workbook API to use for this collection
+        customer_ids (Set): IDs of customers to get
+        '''
+
+        try:
+          customers = {
+            c['Id']:c for c in wb.get_costumers() if c['Id'] in customer_ids}
+        except Exception as e:
+          logging.error("Could not get all customers from Workbook: {}".format(e))
+          customers = {}
+
+        # Fall back to getting customers one by one
+        missing = customer_ids - set(customers.keys())
+        if missing:
+          logging.debug("Getting {} customers one by one".format(len(missing)))
+          customers.update(self.fan_out(
+            lambda c_id: wb.get_costumers(costumer_id=c_id), missing))
+
+        return customers
+
+
+    async def get_data_async(self, wb, keys):
+        '''Get the same data as get_data(), but with the calls to Workbook
+        made from coroutines on a single event loop. Calls not depending
+        on each other are in flight at the same time.
+
+        Returns the data, and the number of requests made to Workbook.
+        Data which could not be had is left out, like in get_data().
+        '''
+
+        async with self.async_workbook() as async_wb:
+
+          # Use the same cache, and data from this collection, as the threads engine
+          wb = cached_wb = CachedWorkbookAPI(
+            async_wb, self.cache, wb.memo, self.limiter, self.stats)
+
+          async def get_currencies():
+            return {c['Id']:c['Iso4127'] for c in await wb.get_currencies()}
+
+          async def get_companies():
+            companies = filter_companies(
+              {c['Id']:c for c in await wb.get_companies(active=True)},
+              self.companies_to_get)
+
+            # Get full company info from WB
+            companies_info = await asyncio.gather(
+              *[wb.get_company(CompanyId=c_id) for c_id in companies.keys()])
+
+            # Add currency_id to companies
+            for c_data, c_info in zip(companies.values(), companies_info):
+              c_data['CurrencyId'] = c_info['CurrencyID']
+
+            return companies
+
+          async def get_employees():
+            companies = await companies_task
+            employees = {}
+            for e_list in await asyncio.gather(
+              *[wb.get_employees(Active=True, CompanyId=c_id) for c_id in companies.keys()]):
+              for e in e_list:
+                employees[e['Id']] = Employee.from_wb(e)
+            return employees
+
+          async def get_capacity_profiles():
+            employees = await employees_task
+            # Employees failing are left out
+            employees_profiles = await wb.fan_out(
+              wb.get_capacity_profiles, employees.keys())
+            return {
+              e_id:pick_capacity_profile(profiles, employees[e_id]) for \
+              e_id, profiles in employees_profiles.items()
+              }
+
+          async def get_departments():
+            return {d['Id']:Department.from_wb(d) for d in await wb.get_departments()}
+
+          async def get_jobs():
+            companies = await companies_task
+            jobs = {}
+            j_lists = await asyncio.gather(
+              *[wb.get_jobs(Status=self.active_jobs, CompanyId=c_id) for c_id in companies.keys()])
+            for c_id, j_list in zip(companies.keys(), j_lists):
+              for j in j_list:
+                jobs[j['Id']] = Job.from_wb(j, company_id=c_id)
+            return jobs
+
+          async def get_customers():
+            jobs = await jobs_task
+            customer_ids = {j.customer_id for j in jobs.values()}
+
+            # All customers in a single request
+            try:
+              customers = {
+                c['Id']:c for c in await wb.get_costumers() if c['Id'] in customer_ids}
+            except Exception as e:
+              logging.error("Could not get all customers from Workbook: {}".format(e))
+              customers = {}
+
+            # Fall back to getting customers one by one
+            customers.update(await wb.fan_out(
+              lambda c_id: wb.get_costumers(costumer_id=c_id),
+              customer_ids - set(customers.keys())))
+
+            return customers
+
+          async def get_creditors():
+            return creditor_observations(
+              Creditor.from_wb(c) for c in await wb.get_creditors())
+
+          async def get_prices():
+            return current_prices(Price.from_wb(p) for p in \
+              await wb.get_employee_prices_hour(ActiveEmployees=True))
+
+          async def get_accounts():
+            companies = await companies_task
+            accounts = await wb.get_finance_accounts(
+              TypeIds=self.finance_account_types,
+              Companies=companies.keys())
+
+            # Accounts failing are left out, and will not be reported
+            balances = await wb.fan_out(
+              lambda i: wb.get_finance_account_balance(
+                CompanyId=accounts[i]['CompanyId'],
+                AccountId=accounts[i]['Id'],
+                ),
+              range(len(accounts))
+              )
+            for i, balance_list in balances.items():
+              add_account_balance(accounts[i], balance_list)
+
+            return accounts
+
+          # Tasks other coroutines depend on
+          companies_task = asyncio.ensure_future(get_companies()) \
+            if 'companies' in keys else None
+          employees_task = asyncio.ensure_future(get_employees()) \
+            if 'employees' in keys else None
+          jobs_task = asyncio.ensure_future(get_jobs()) \
+            if 'jobs' in keys else None
+
+          getters = {
+            'currencies': get_currencies,
+            'companies': lambda: companies_task,
+            'employees': lambda: employees_task,
+            'capacity_profiles': get_capacity_profiles,
+            'departments': get_departments,
+            'jobs': lambda: jobs_task,
+            'creditors': get_creditors,
+            'prices': get_prices,
+            'accounts': get_accounts,
+            'customers': get_customers
+            }
+
+          # Data is listed after the data it depends on
+          keys = [k for k in self.DATA_DEPENDENCIES.keys() if k in keys]
+          try:
+            values = await asyncio.gather(
+              *[getters[k]() for k in keys], return_exceptions=True)
+          finally:
+            # Do not leave tasks running if something failed
+            for task in [companies_task, employees_task, jobs_task]:
+              if task:
+                task.cancel()
+
+          data = {}
+          for k, v in zip(keys, values):
+            if not isinstance(v, Exception):
+              data[k] = v
+            elif all(d in data for d in self.DATA_DEPENDENCIES[k]):
+              logging.error("Could not get {} from Workbook: {}".format(k, v))
+            else:
+              logging.debug("Could not get {}, because data it depends on is missing".format(k))
+
+          return data, cached_wb.no_of_requests
+
+
+    def async_workbook(self):
+        '''Returns an AsyncWorkbookAPI for the Workbook of this collector'''
+        return AsyncWorkbookAPI(
+          self.wb_url, self.wb_user, self.wb_pass,
+          connections=self.workers,
+          request_timeout=self.request_timeout,
+          stats=self.stats)
+
+
+    def run_async(self, wb, func):
+        '''Returns what awaiting func(async_wb) returns, in an event loop
+        of its own. async_wb is a CachedWorkbookAPI over an AsyncWorkbookAPI,
+        sharing the cache, memo and rate limiter of wb (A CachedWorkbookAPI).
+        The requests made are counted by wb.'''
+
+        async def run():
+          async with self.async_workbook() as async_wb:
+            cached_wb = CachedWorkbookAPI(
+              async_wb, self.cache, wb.memo, self.limiter, self.stats)
+            try:
+              return await func(cached_wb)
+            finally:
+              wb.count_request(cached_wb.no_of_requests)
+
+        return asyncio.run(run())
+
+
+    def get_state(self):
+        '''Returns data from Workbook kept between collections'''
+        return {
+          'cache': self.cache.get_state(),
+          'time_entries': self.time_entries.get_state(),
+          'last_good': dict(self.last_good)
+          }
+
+
+    def set_state(self, state):
+        '''Restore data returned by get_state()'''
+        self.cache.set_state(state['cache'])
+        self.time_entries.set_state(state['time_entries'])
+        # Not in states saved before sections failed on their own
+        self.last_good = dict(state.get('last_good', {}))
+
+
+    def section_digests(self, sections, data):
+        '''Returns digests of the data used by sections, for the sections
+        not in STREAMING_SECTIONS. Metrics depending on the date (Like
+        days since employment) change every day, so the date is included.
+        '''
+        sections = [s for s in sections if s not in self.STREAMING_SECTIONS]
+        keys = {k for s in sections for k in self.SECTIONS[s] if k in data}
+        key_digests = {k:fingerprint(data[k]) for k in keys}
+
+        today = datetime.now().date()
+        return {s:(today, tuple(key_digests[k] for k in self.SECTIONS[s]))
+          for s in sections if all(k in key_digests for k in self.SECTIONS[s])}
+
+
+    def collect_section(self, section, wb, data):
+        '''Returns a list of the metrics of section, and True if
+        the section could not be collected completely'''
+
+        missing = [k for k in self.SECTIONS[section] if k not in data]
+        if missing:
+          logging.error("Could not collect section {}, because data is missing: {}"
+            .format(section, ", ".join(missing)))
+          return [], True
+
+        metrics = []
+        sections_metrics = getattr(self, 'collect_' + section)(wb, data)
+        try:
+          while True:
+            metrics.append(next(sections_metrics))
+        except StopIteration as e:
+          # The section returns True on errors
+          return merge_families(metrics), bool(e.value)
+        except Exception as e:
+          logging.error("Could not collect section {}: {}".format(section, e))
+          return merge_families(metrics), True
+
+
+    def get_process_pool(self):
+        '''Returns the pool of processes collecting sections, starting
+        it if needed'''
+        with self.process_pool_lock:
+          if not self.process_pool:
+            # Processes are spawned, as forking a process
+            # running threads is not safe
+            context = multiprocessing.get_context('spawn')
+
+            # Records logged in the processes are sent here, and handled
+            # by the handlers of this process (Set up by the command line)
+            root = logging.getLogger()
+            if not self.log_listener:
+              self.log_queue = context.Queue()
+              self.log_listener = logging.handlers.QueueListener(
+                self.log_queue, *root.handlers, respect_handler_level=True)
+              self.log_listener.start()
+
+            self.process_pool = concurrent.futures.ProcessPoolExecutor(
+              max_workers=self.aggregation_processes,
+              mp_context=context,
+              initializer=init_aggregation_process,
+              initargs=(JOB_AGE_BUCKETS, CLIENT_AGE_BUCKETS,
+                self.log_queue, root.level))
+          return self.process_pool
+
+
+    def reset_process_pool(self):
+        '''Shut down the pool of processes, if a process died, so a new
+        pool is started on next use'''
+        with self.process_pool_lock:
+          if self.process_pool:
+            self.process_pool.shutdown(wait=False)
+            self.process_pool = None
+
+
+    def submit_shards(self, sections, data):
+        '''Start collecting sections pr. company in the pool of processes.
+        The data of every company is sent to a process once, and all the
+        sections are collected from it there.
+
+        Returns a dict with the sections as keys, and lists of futures of
+        the metrics of every company as values. Sections with missing data
+        are left out.
+
+        Keyword arguments:
+        sections (List): Names of sections in SHARDED_SECTIONS
+        data (Dict): Data from get_data()
+        '''
+
+        sections = [s for s in sections
+          if all(k in data for k in self.SECTIONS[s])]
+        if not sections:
+          return {}
+
+        collector = ShardCollector(self.active_jobs)
+        pool = self.get_process_pool()
+
+        shards = shard_data(data, {k for s in sections for k in self.SECTIONS[s]})
+        futures = [pool.submit(collect_shard, collector, sections, shard)
+          for shard in shards.values()]
+
+        return {s:futures for s in sections}
+
+
+    def gather_shards(self, section, futures):
+        '''Returns a list of the metrics of section, collected pr. company
+        by submit_shards(), and True if the section could not be collected
+        completely'''
+
+        metrics = []
+        section_error = False
+        for f in futures:
+          try:
+            shard_metrics, shard_error = f.result()[section]
+          except Exception as e:
+            logging.error("Could not collect section {} in a worker process: {}"
+              .format(section, e))
+            section_error = True
+            if isinstance(e, concurrent.futures.BrokenExecutor):
+              self.reset_process_pool()
+          else:
+            metrics.extend(shard_metrics)
+            section_error = section_error or shard_error
+
+        return merge_families(metrics), section_error
+
+
+    def collect_finance_accounts(self, wb, data):
+        '''Yields the balances of finance accounts.
+        Returns True if data could not be had from Workbook.'''
+
+        currencies = data['currencies']
+        companies = data['companies']
+        accounts = data['accounts']
+
+        # Assume no problems with getting data from Workbook
+        wb_error = False
+
+        # FINANCE ACCOUNTS
+
+        for a in accounts:
+          # Some account types (2?) has no balance
+          # It's only used cosmetically in Workbook
+          if a.get('balance'):
+
+            # Get the currency to use
+            currency_id = companies[a['CompanyId']]['CurrencyId']
+            g = GaugeMetricFamily(
+              'workbook_finance_account_balance',
+              'Balance of finance account',
+              labels=[
+                'company_id',
+                'currency',
+                'account_id',
+                'account_description',
+                'account_number'
+                ]
+              )
+            g.add_metric(
+                [str(a['CompanyId']),
+                str(currencies[currency_id]),
+                str(a['Id']), str(a['AccountDescription']),
+                str(a['AccountNumber'])],
+                a['balance']
+              )
+            yield g
+
+        return wb_error
+
+
+    def collect_time_entries(self, wb, data):
+        '''Yields sums of time entries pr. department.
+        Returns True if data could not be had from Workbook.'''
+
+        currencies = data['currencies']
+        companies = data['companies']
+        departments = data['departments']
+        employees = data['employees']
+        capacity_profiles = data['capacity_profiles']
+        jobs = data['jobs']
+        prices_dict = data['prices']
+
+        # Assume no problems with getting data from Workbook
+        wb_error = False
+
+        # FIXME: Add list of company ids to look for
+        # Days to look in to the past for timeentries
+        time_entry_days = self.time_entries.days
+
+        # TIME ENTRIES #
+        # Time entries don't have ClientIds
+        # FIxme: (We could look them up in jobs?)
+
+        # Top key is company_id:department_id
+        time_entries_data = {c_id:{} for c_id in companies.keys()}
+
+        # Add departments
+        for d_id, d in departments.items():
+            c_data = time_entries_data.get(d.company_id)
+            if c_data is not None:
+                c_data[d_id] = {
+                    'billable': 0,
+                    'total': 0,
+                    'revenue': 0,
+                    'resource_ids': set(),
+                    'job_ids': set(),
+                    'customer_ids': set()
+                    }
+
+        # TIME ENTRIES #
+        try:
+          if self.engine == 'asyncio':
+            self.run_async(wb, lambda async_wb: self.time_entries.sync_async(
+              async_wb, employees, jobs, prices_dict))
+          else:
+            self.time_entries.sync(wb, employees, jobs, prices_dict)
+        except Exception as e:
+            print("Could not get WB time entries with error: {}".format(e))
+            wb_error = True
+        else:
+            # FIXME: Number of clients worked on
+            # Use sums for the departments we report on
+            for (c_id, d_id), a in self.time_entries.get_aggregates().items():
+                if d_id in time_entries_data.get(c_id, {}):
+                    time_entries_data[c_id][d_id] = a
+
+            # Number of employees who must enter time, and the sum of
+            # their work hours pr. week, with department IDs as keys
+            d_no_of_employees = collections.Counter()
+            d_work_hours = collections.Counter()
+            for e in employees.values():
+                if e.time_registration:
+                    d_no_of_employees[e.department_id] += 1
+            for p in capacity_profiles.values():
+                e = employees.get(p['ResourceId'])
+                if e and e.time_registration:
+                    d_work_hours[e.department_id] += p['hours_week']
+
+            # Labels to use for the following metrics
+            label_names = [
+              'days',
+              'company_id',
+              'department_id',
+              'department_name'
+              ]
+
+            # Run through the time entries
+            for c_id, c_data in time_entries_data.items():
+
+                # Get currency for company
+                currency_id = companies[c_id]['CurrencyId']
+                currency = currencies[currency_id]
+
+                for d_id, d_data in c_data.items():
+                    # Values for the labels
+                    label_values = [
+                        str(time_entry_days),
+                        str(c_id),
+                        str(d_id),
+                        departments[d_id].name.strip()
+                        ]
+
+                    g = GaugeMetricFamily(
+                      'workbook_time_entry_hours_total',
+                      'Sum of hours entered by employees', labels=label_names)
+                    g.add_metric(label_values, d_data['total'])
+                    yield g
+
+                    g = GaugeMetricFamily(
+                      'workbook_time_entry_hours_billable',
+                      'Number of billable hours', labels=label_names)
+                    g.add_metric(label_values, d_data['billable'])
+                    yield g
+
+                    g = GaugeMetricFamily(
+                      'workbook_time_entry_revenue',
+                      'Billable hours times sales price pr. hour', labels=label_names + ['currency'])
+                    g.add_metric(label_values + [currency], d_data['revenue'])
+                    yield g
+
+                    g = GaugeMetricFamily(
+                      'workbook_time_entry_people_total',
+                      'Number of people who must enter time', labels=label_names)
+                    g.add_metric(label_values, d_no_of_employees[d_id])
+                    yield g
+
+                    # Sum of work hours for all employees in department
+                    sum_of_work_hours = d_work_hours[d_id]
+
+                    g = GaugeMetricFamily(
+                      'workbook_time_entry_hours_capacity_total',
+                      'Sum of hours to be entered', labels=label_names)
+                    g.add_metric(label_values, sum_of_work_hours)
+                    yield g
+
+                    g = GaugeMetricFamily(
+                      'workbook_time_entry_people_with_time',
+                      'Number of people having entered time entries', labels=label_names)
+                    g.add_metric(label_values, len(d_data['resource_ids']))
+                    yield g
+
+                    g = GaugeMetricFamily(
+                      'workbook_time_entry_jobs_total',
+                      'Number of jobs with time entries', labels=label_names)
+                    g.add_metric(label_values, len(d_data['job_ids']))
+                    yield g
+
+                    g = GaugeMetricFamily(
+                      'workbook_time_entry_customers_total',
+                      'Number of customers with time entries', labels=label_names)
+                    g.add_metric(label_values, len(d_data['customer_ids']))
+                    yield g
+
+        return wb_error
+
+
+    def collect_employee_prices(self, wb, data):
+        '''Yields histograms of employee prices pr. department.
+        Returns True if data could not be had from Workbook.'''
+
+        currencies = data['currencies']
+        companies = data['companies']
+        departments = data['departments']
+        employees = data['employees']
+        prices_dict = data['prices']
+
+        # Buckets for histograms
+        profit_buckets = [0.2, 0.4, 0.6, 0.8]
+        hours_sale_buckets = [500, 1000, 1500, 2000]
+        hours_cost_buckets = [250, 500, 750, 1000]
+
+        # Assume no problems with getting data from Workbook
+        wb_error = False
+
+        # EMPLOYEE PRICES #
+        try:
+            # Get prices for active employees
+            #prices = self.wb.get_employee_prices_hour(ActiveEmployees=True)
+            pass
+        except Exception as e:
+            print("Could not get WB employees prices with error: {}".format(e))
+            wb_error = True
+        else:
+            # A dict with company id as key for dicts with EmployeeId as key.
+            # An employee can have more than 1 entry.
+            # Only store the newest. They have ValidFrom date.
+            # We don't know the company IDs  
+            price_dict = {c_id:{} for c_id in companies.keys()}
+
+            # Run through dict of current prices
+            for e_id, e_prices in prices_dict.items():
+
+                # company list
+                try:
+                  # The employee
+                  e = employees[e_id]
+                  # Employee's company
+                  c_id = e.company_id
+                  # Employees's department
+                  d_id = e.department_id
+                except KeyError:
+                  # Abort because employee ID from price is not
+                  # in employees (Not employed at company we report for)
+                  # (Can not filter on companies for prices)
+                  continue
+
+                # Don't process users not registering time
+                if not e.time_registration:
+                  logging.debug("Ignoring user {} when reporting employee prices"
+                    .format(e.name))
+                  continue
+
+                # Add department dict if needed
+                if d_id not in price_dict[c_id]:
+                  price_dict[c_id][d_id] = {}
+
+                # Add employees prices to dict
+                price_dict[c_id][d_id][e_id] = e_prices
+
+            # Loop through company price dicts
+            for c_id, c_prices in price_dict.items():
+                for d_id, d_prices in c_prices.items():
+                    currency_id = companies[c_id]['CurrencyId']
+                    currency = currencies[currency_id]
+                    d_name = departments[d_id].name
+
+                    # Store observations for company here
+                    observations = {
+                      'Profit': [],
+                      'HoursCost': [],
+                      'HoursSale': []
+                      }
+
+                    # Loop price data, and add to observations dicts
+                    for e_id, p in d_prices.items():
+                      for field, value in [
+                        ('Profit', p.profit),
+                        ('HoursCost', p.hours_cost),
+                        ('HoursSale', p.hours_sale)]:
+
+                        # Add observation if present
+                        if value is not None:
+                          observations[field].append(value)
+                        else:
+                          observations[field].append(0.0)
+                          logging.warning("Missing key '{}' for employee '{}'. Inserted 0.0"
+                            .format(field, employees[e_id].name))
+
+                    # PROFIT #
+                    yield build_histogram(
+                      observations['Profit'],
+                      profit_buckets,
+                      'workbook_employees_profit_ratio',
+                      'Estimated profit on 1 hours work',
+                      ['company_id', 'department_id', 'department_name'],
+                      [str(c_id), str(d_id), d_name])
+
+                    # HOURS SALE #
+                    yield build_histogram(
+                      observations['HoursSale'],
+                      hours_sale_buckets,
+                      'workbook_employees_hours_sale',
+                      'Estimated sales price of 1 hours work',
+                      ['company_id', 'department_id', 'department_name', 'currency'],
+                      [str(c_id), str(d_id), d_name, currency])
+
+                    # HOURS COST #
+                    yield build_histogram(
+                      observations['HoursCost'],
+                      hours_cost_buckets,
+                      'workbook_employees_hours_cost',
+                      'Estimated cost of 1 hours work',
+                      ['company_id', 'department_id', 'department_name', 'currency'],
+                      [str(c_id), str(d_id), d_name, currency])
+
+        return wb_error
+
+
+    def collect_employees(self, wb, data):
+        '''Yields histograms of days employed pr. company.
+        Returns True if data could not be had from Workbook.'''
+
+        companies = data['companies']
+        employees = data['employees']
+
+        # Buckets for histograms
+        days_employed_buckets = [3*30, 5*30, 2*12*30+9*30, 5*12*30+8*30, 8*12*30+7*30]
+
+        # Assume no problems with getting data from Workbook
+        wb_error = False
+
+        # EMPLOYEES DAYS EMPLOYED #
+        # Active employees with company IDs as keys
+        employees_by_company = {c_id:[] for c_id in companies.keys()}
+        for e in employees.values():
+            if e.company_id in employees_by_company:
+                employees_by_company[e.company_id].append(e)
+
+        for company_id in companies.keys():
+            # Gather observations (Days since employment)
+            observations = []
+            for e in employees_by_company[company_id]:
+                if e.hire_date:
+                    observations.append((datetime.today() - e.hire_date).days)
+
+            # Job age histogram (Non billable)
+            yield build_histogram(
+               observations,
+               days_employed_buckets,
+               'workbook_employees_days_employed',
+               'Days since employment',
+               ['company_id'],
+               [str(company_id)])
+
+        return wb_error
+
+
+    def collect_jobs(self, wb, data):
+        '''Yields statistics on active jobs, and their customers, pr. company.
+        Returns True if data could not be had from Workbook.'''
+
+        companies = data['companies']
+        jobs = data['jobs']
+        customers = data['customers']
+
+        # Assume no problems with getting data from Workbook
+        wb_error = False
+
+        # FIXME: Add config with costumers to ignore (Pseudo costumers)
+        # FIXME: Active clients pr. department
+        # JOBS #
+        # Active jobs with company IDs as keys
+        jobs_by_company = {c_id:[] for c_id in companies.keys()}
+        for j in jobs.values():
+            if j.company_id in jobs_by_company:
+                jobs_by_company[j.company_id].append(j)
+
+        for company_id in companies.keys():
+            # Gather observations (Days since employment)
+            observations = {
+                'billable': [],
+                'non_billable': [],
+                'status_id_billable': [],
+                'status_id': []
+                }
+            active_clients = {
+                'billable': set(),
+                'non_billable': set()
+                }
+            #no_of_billable_jobs = 0
+            for j in jobs_by_company[company_id]:
+                # Days since job was created
+                job_age = (datetime.today() - j.create_date).days
+
+                if j.billable:
+                    observations['billable'].append(job_age)
+                    active_clients['billable'].add(j.customer_id)
+                    observations['status_id_billable'].append(j.status_id)
+                else:
+                    observations['non_billable'].append(job_age)
+                    active_clients['non_billable'].add(j.customer_id)
+
+                observations['status_id'].append(j.status_id)
+
+            # Job status histogram (billable)
+            yield build_histogram(
+               observations['status_id_billable'],
+               self.active_jobs,
+               'workbook_jobs_status_billable',
+               'Status of billable jobs',
+               ['company_id'],
+               [str(company_id)])
+
+            # Job status histogram (Total)
+            yield build_histogram(
+               observations['status_id'],
+               self.active_jobs,
+               'workbook_jobs_status_total',
+               'Status of all jobs',
+               ['company_id'],
+               [str(company_id)])
+
+            # Job age histogram (billable)
+            yield build_histogram(
+               observations['billable'],
+               JOB_AGE_BUCKETS,
+               'workbook_jobs_age_days',
+               'Days since job was created',
+               ['company_id', 'billable'],
+               [str(company_id), '1'])
+
+            # Job age histogram (Non billable)
+            yield build_histogram(
+               observations['non_billable'],
+               JOB_AGE_BUCKETS,
+               'workbook_jobs_age_days',
+               'Days since job was created',
+               ['company_id', 'billable'],
+               [str(company_id), '0'])
+
+            cust_billable = GaugeMetricFamily(
+                'workbook_active_customers_billable_jobs',
+                'No of unique customers for billable active jobs',
+                labels=["company_id"])
+            cust_billable.add_metric(
+                [str(company_id)],
+                len(active_clients['billable']))
+            yield cust_billable
+
+            cust_total = GaugeMetricFamily(
+                'workbook_active_customers_total_jobs',
+                'No of unique customers for all active jobs',
+                labels=["company_id"])
+            cust_total.add_metric(
+              [str(company_id)],
+              len(active_clients['non_billable'].union(active_clients['billable']))
+              )
+            yield cust_total
+
+            # Active client age
+            # Billable
+            client_age_billable = []
+            for c in [customers[c_id] for c_id in active_clients['billable'] \
+              if c_id in customers]:
+              # Observe WonDate
+              if c.get('WonDate'):
+                won_date = parse_date(c.get('WonDate'))
+                client_age_billable.append((datetime.today() - won_date).days)
+              else:
+                # Client has no WonDate?
+                logging.warning("Customer {} with billable job has no 'WonDate' in Workbook".format(c['Name']))
+
+            # Client age histogram (billable)
+            yield build_histogram(
+               client_age_billable,
+               CLIENT_AGE_BUCKETS,
+               'workbook_active_customers_age_days',
+               'Days since client was created',
+               ['company_id', 'billable'],
+               [str(company_id), '1'])
+
+            # Non billable
+            client_age_non_billable = []
+            for c in [customers[c_id] for c_id in active_clients['non_billable'] \
+              if c_id in customers]:
+              # Observe WonDate
+              if c.get('WonDate'):
+                won_date = parse_date(c.get('WonDate'))
+                client_age_non_billable.append((datetime.today() - won_date).days)
+              else:
+                # Client has no WonDate?
+                logging.warning("Customer {} with non billable job has no 'WonDate' in Workbook".format(c['Name']))
+
+            # Client age histogram (Non billable)
+            yield build_histogram(
+               client_age_non_billable,
+               CLIENT_AGE_BUCKETS,
+               'workbook_active_customers_age_days',
+               'Days since client was created',
+               ['company_id', 'billable'],
+               [str(company_id), '0'])
+
+        return wb_error
+
+
+    def collect_credit(self, wb, data):
+        '''Yields histograms of amounts owed to creditors pr. company.
+        Returns True if data could not be had from Workbook.'''
+
+        currencies = data['currencies']
+        companies = data['companies']
+        creditors = data['creditors']
+
+        # Buckets for histograms
+        # FIXME: Credit/Debit buckets should probably be currency dependant
+        credit_buckets = [-50000, -25000, -10000, 0, 10000, 25000, 50000]
+
+        # Assume no problems with getting data from Workbook
+        wb_error = False
+
+        # CREDIT #
+        try:
+            # Get all creditors accross companies
+            #creditors = self.wb.get_creditors()
+            pass
+        except Exception as e:
+            print("Error: {}".format(e))
+            wb_error = True
+        else:
+            for company_id in companies.keys():
+                # Get currency
+                currency_id = companies[company_id]['CurrencyId']
+                currency = currencies[currency_id]
+
+                # Credit observations for current company
+                observations = creditors.get(company_id, {
+                    'total': [],
+                    'due': [],
+                    })
+
+                # Report metrics if no errors in WB
+                if not wb_error:
+                    # Credit total
+                    yield build_histogram(
+                       observations['total'],
+                       credit_buckets,
+                       'workbook_credit_total',
+                       'Amount owed',
+                       ['company_id', 'currency'],
+                       [str(company_id), currency])
+
+                    # Credit due
+                    yield build_histogram(
+                       observations['due'],
+                       credit_buckets,
+                       'workbook_credit_due',
+                       'Amount owed',
+                       ['company_id', 'currency'],
+                       [str(company_id), currency])
+
+        return wb_error
+
+
+    def collect_debit(self, wb, data):
+        '''Yields histograms of amounts owed by debtors pr. company.
+        Returns True if data could not be had from Workbook.'''
+
+        currencies = data['currencies']
+        companies = data['companies']
+
+        # Buckets for histograms
+        # FIXME: Credit/Debit buckets should probably be currency dependant
+        debit_buckets = [-50000, -25000, -10000, 0, 10000, 25000, 50000, 100000]
+
+        # Assume no problems with getting data from Workbook
+        wb_error = False
+
+        # DEBIT #
+        for company_id, debtors in self.get_debtors_balances(wb, companies.keys()):
+            # Get currency
+            currency_id = companies[company_id]['CurrencyId']
+            currency = currencies[currency_id]
+            if isinstance(debtors, Exception):
+                print("Error: {}".format(debtors))
+                wb_error = True
+            else:
+                observations = {
+                    'total': HistogramBins(debit_buckets),
+                    'due': HistogramBins(debit_buckets),
+                    }
+                # Run through debtors for current company
+                for d in debtors:
+                    c_id = d.get('CurrencyId', False)
+                    if c_id:
+                        total = d.get('RemainingAmountTotal', None)
+                        due = d.get('RemainingAmountDue', None)
+
+                        if due:
+                            observations['due'].update([due])
+
+                        if total:
+                            observations['total'].update([total])
+
+                # Report metrics if no errors from WB
+                if not wb_error:
+                  # Debit total
+                  yield build_histogram(
+                     observations['total'],
+                     debit_buckets,
+                     'workbook_debit_total',
+                     'Debit total',
+                     ['company_id', 'currency'],
+                     [str(company_id), currency])
+  
+                  # Debit due
+                  yield build_histogram(
+                     observations['due'],
+                     debit_buckets,
+                     'workbook_debit_due',
+                     'Debit due',
+                     ['company_id', 'currency'],
+                     [str(company_id), currency])
+
+        return wb_error
+
+
+    def get_debtors_balances(self, wb, company_ids):
+        '''Yields (company_id, debtors) for every company, with the exception
+        raised in place of the debtors, if they could not be had. The asyncio
+        engine gets all companies at once, the threads engine one at a time.'''
+
+        if self.engine == 'asyncio':
+          company_ids = list(company_ids)
+
+          async def get_balances(async_wb):
+            return await asyncio.gather(
+              *[async_wb.get_debtors_balance(company_id=c_id) for c_id in company_ids],
+              return_exceptions=True)
+
+          for c_id, debtors in zip(company_ids, self.run_async(wb, get_balances)):
+            yield c_id, debtors
+          return
+
+        for c_id in company_ids:
+          try:
+            debtors = wb.get_debtors_balance(company_id=c_id)
+          except Exception as e:
+            debtors = e
+          yield c_id, debtors
+
+
+    def collect_shared(self):
+        '''Yields metrics on the cache, the rate limiter, the requests and
+        the sections reused, which are shared by all collections'''
+        for m in self.cache.collect():
+          yield m
+        for m in self.limiter.collect():
+          yield m
+        for m in self.stats.collect():
+          yield m
+        if self.changes:
+          for m in self.changes.collect():
+            yield m
+
+        no_of_unchanged = dict(self.no_of_unchanged)
+        c = CounterMetricFamily(
+          'workbook_sections_unchanged',
+          'Collections of sections reusing the metrics of the last one, because the data was unchanged',
+          labels=['section'])
+        for section in sorted(no_of_unchanged.keys()):
+          c.add_metric([section], no_of_unchanged[section])
+        yield c
+
+
+    def collect(self, sections=None):
+        '''Collect metrics from Workbook
+
+        Keyword arguments:
+        sections (List): Names of the sections (In SECTIONS) to collect. All if None.
+        '''
+
+        if sections is None:
+          sections = list(self.SECTIONS.keys())
+
+        logging.info("Getting data from Workbook.")
+        logging.debug("Collecting sections: {}".format(", ".join(sections)))
+
+        scrape_start_time = time.monotonic()
+
+        # Seconds spent on every phase of the collection
+        phase_durations = collections.OrderedDict()
+
+        # Metric for status on getting data from WB
+        workbook_up = GaugeMetricFamily(
+            'workbook_up', 'Is data beeing pulled from Workbook')
+
+        # Assume no problems with getting data from Workbook
+        wb_error = False
+
+        # Count requests made to Workbook, and make every call to
+        # Workbook at most once, during this collection
+        wb = CachedWorkbookAPI(
+          self.wb.wb, self.cache, ScrapeMemo(), self.limiter, self.stats)
+
+        # Requests made by the asyncio engine
+        no_of_async_requests = 0
+
+        # Get all the data from WB. Data which could not be
+        # had is left out, and sections using it fail.
+        try:
+            if self.engine == 'asyncio':
+              data, no_of_async_requests = asyncio.run(
+                self.get_data_async(wb, self.data_keys(sections)))
+            else:
+              data = self.get_data(wb, self.data_keys(sections))
+        except Exception as e:
+            logging.error("Could not get data from Workbook: {}".format(e))
+            data = {}
+        else:
+          logging.info("Done getting data from Workbook")
+        phase_durations['get_data'] = time.monotonic() - scrape_start_time
+
+        # Was every section collected?
+        section_up = GaugeMetricFamily(
+            'workbook_section_up',
+            'Was the section of metrics collected from Workbook in the latest collection',
+            labels=['section'])
+
+        # Sections with the same data as in their last good
+        # collection, reuse the metrics of that collection
+        digests = self.section_digests(sections, data)
+        unchanged = {s for s, digest in digests.items()
+          if digest == self.digests.get(s) and s in self.last_good}
+
+        # Start collecting sections pr. company in other processes,
+        # while the rest are collected here
+        shards = {}
+        if self.aggregation_processes:
+          try:
+            shards = self.submit_shards([s for s in sections
+              if s in self.SHARDED_SECTIONS and s not in unchanged], data)
+          except Exception as e:
+            logging.error("Could not collect sections in worker processes: {}".format(e))
+            if isinstance(e, concurrent.futures.BrokenExecutor):
+              self.reset_process_pool()
+
+        # The metrics served for every section
+        section_metrics = {}
+
+        # Collect the sections on their own, so one failing does not
+        # spoil the rest. Serve the last good metrics of failed sections.
+        for section in sections:
+          section_start_time = time.monotonic()
+          digest = digests.get(section)
+          if section in unchanged:
+            logging.debug("Data of section {} is unchanged. Reusing its metrics".format(section))
+            self.no_of_unchanged[section] += 1
+            metrics, section_error = self.last_good[section], False
+          elif section in shards:
+            metrics, section_error = self.gather_shards(section, shards[section])
+          else:
+            metrics, section_error = self.collect_section(section, wb, data)
+          if not section_error:
+            self.last_good[section] = metrics
+            self.digests[section] = digest
+          elif section in self.last_good:
+            logging.warning("Serving the last good metrics of section {}".format(section))
+            metrics = self.last_good[section]
+          section_metrics[section] = metrics
+          for m in metrics:
+            yield m
+          section_up.add_metric([section], 0 if section_error else 1)
+          wb_error = wb_error or section_error
+          phase_durations[section] = time.monotonic() - section_start_time
+
+        yield section_up
+
+        # Publish the series changed since the last collection
+        if self.changes:
+          try:
+            self.changes.update(section_metrics)
+          except Exception as e:
+            logging.error("Could not publish changed series: {}".format(e))
+
+        # How long did every phase take?
+        g = GaugeMetricFamily(
+            'workbook_collection_phase_duration_seconds',
+            'Number of seconds it took to get the data, and to collect every section',
+            labels=['phase'])
+        for phase, seconds in phase_durations.items():
+          g.add_metric([phase], seconds)
+        yield g
+
+        # How many requests did we make to the Workbook API?
+        no_of_wb_requests = wb.no_of_requests + no_of_async_requests
+        g = GaugeMetricFamily(
+            'workbook_no_of_api_requests',
+            'Number of requests to Workbook performed during scrape')
+        g.add_metric([], no_of_wb_requests)
+        yield g
+
+        scrape_time_seconds = time.monotonic() - scrape_start_time
+        # How long did the scape take?
+        g = GaugeMetricFamily(
+            'workbook_scrape_duration_seconds',
+            'Number of seconds it took to perform scrape')
+        g.add_metric([], scrape_time_seconds)
+        yield g
+
+
+        # Metrics on the cache and rate limit of Workbook data
+        for m in self.collect_shared():
+          yield m
+
+        # Problems getting data from workbook?
+        if wb_error:
+            workbook_up.add_metric([], 0)
+        else:
+            workbook_up.add_metric([], 1)
+        yield workbook_up
+
+
+
+        if wb_error:
+          logging.error("Error exporting data from workbook")
+        else:
+          logging.info("Scrape finished in {:.2f} seconds with {} requests to Workbook API"
+            .format(scrape_time_seconds, no_of_wb_requests))
+
+
+class ShardCollector(object):
+    '''The parts of a WorkbookCollector needed for collecting the
+    sections in SHARDED_SECTIONS from data, sent to worker processes
+    '''
+
+    SECTIONS = WorkbookCollector.SECTIONS
+
+    collect_section = WorkbookCollector.collect_section
+    collect_finance_accounts = WorkbookCollector.collect_finance_accounts
+    collect_employee_prices = WorkbookCollector.collect_employee_prices
+    collect_employees = WorkbookCollector.collect_employees
+    collect_jobs = WorkbookCollector.collect_jobs
+    collect_credit = WorkbookCollector.collect_credit
+
+    def __init__(self, active_jobs):
+        self.active_jobs = active_jobs
+
+
+def init_aggregation_process(job_age_buckets, client_age_buckets, log_queue, log_level):
+    '''Set up a worker process with the buckets from the config file, and
+    logging to log_queue, to be handled by the exporter process'''
+    global JOB_AGE_BUCKETS
+    JOB_AGE_BUCKETS = job_age_buckets
+    global CLIENT_AGE_BUCKETS
+    CLIENT_AGE_BUCKETS = client_age_buckets
+
+    root = logging.getLogger()
+    root.handlers = [logging.handlers.QueueHandler(log_queue)]
+    root.setLevel(log_level)
+
+
+def collect_shard(collector, sections, data):
+    '''Returns a dict with sections as keys, and the metrics collected
+    from data (The data of a single company) and True if the section could
+    not be collected completely, as values. Runs in a worker process.
+
+    Keyword arguments:
+    collector (ShardCollector): Collects the sections
+    sections (List): Names of sections in SHARDED_SECTIONS
+    data (Dict): Data from shard_data()
+    '''
+    return {s:collector.collect_section(s, None, data) for s in sections}
+
+
+def add_label(metric, name, value):
+    '''Returns a copy of metric with label name set to value'''
+    m = copy.copy(metric)
+    m.samples = [s._replace(labels=dict({name: value}, **s.labels))
+      for s in metric.samples]
+    return m
+
+
+class LabelCache(object):
+    '''Makes labelled copies of metrics (See add_label()). Copies made
+    in the last call are reused for the same metrics, so only new metrics
+    (Like those of a new snapshot) are copied.
+    '''
+
+    def __init__(self):
+        # (metric, copy) with the id of the metric as key. The metric is
+        # kept, so its id is not reused by another metric.
+        self.copies = {}
+
+
+    def label(self, metrics, name, value):
+        '''Returns a list of copies of the iterable metrics with
+        label name set to value'''
+        copies = {}
+        for m in metrics:
+          c = self.copies.get(id(m))
+          if c is None or c[0] is not m:
+            c = (m, add_label(m, name, value))
+          copies[id(m)] = c
+        self.copies = copies
+        return [c[1] for c in copies.values()]
+
+
+def merge_families(metrics):
+    '''Returns a list with a family pr. metric name in the iterable
+    metrics, holding the samples of all families with the name. Names
+    are in the order they first appear.'''
+
+    families = collections.OrderedDict()
+    for m in metrics:
+      families.setdefault(m.name, []).append(m)
+
+    merged = []
+    for name, name_metrics in families.items():
+      if len(name_metrics) == 1:
+        merged.append(name_metrics[0])
+      else:
+        m = copy.copy(name_metrics[0])
+        m.samples = [s for f in name_metrics for s in f.samples]
+        merged.append(m)
+    return merged
+
+
+class ExpositionCache(object):
+    '''Renders metrics in the Prometheus text format, keeping the text of
+    every family. Families are never changed once collected, so a family
+    served before (Like the families of a snapshot) is not rendered
+    again. Only new families are. Families with the same name are served
+    as one.
+    '''
+
+    def __init__(self):
+        # (family, header, samples) with the id of the family as key. The
+        # family is kept, so its id is not reused by another family.
+        self.rendered = {}
+
+        # Families rendered, and reused, in total
+        self.no_of_rendered = 0
+        self.no_of_reused = 0
+
+        # Protects the attributes above
+        self.lock = threading.Lock()
+
+
+    @staticmethod
+    def render_family(metric):
+        '''Returns the header, and the samples, of metric in the text format'''
+        text = generate_latest(types.SimpleNamespace(collect=lambda: [metric]))
+        # The header is the HELP and TYPE lines
+        header_end = text.index(b'\n', text.index(b'\n') + 1) + 1
+        return text[:header_end], text[header_end:]
+
+
+    def render(self, metrics):
+        '''Returns the iterable metrics in the text format (bytes)'''
+
+        families = collections.OrderedDict()
+        for m in metrics:
+          families.setdefault(m.name, []).append(m)
+
+        output = []
+        rendered = {}
+        with self.lock:
+          for name, name_metrics in families.items():
+            for i, m in enumerate(name_metrics):
+              r = self.rendered.get(id(m))
+              if r is None or r[0] is not m:
+                r = (m,) + self.render_family(m)
+                self.no_of_rendered += 1
+              else:
+                self.no_of_reused += 1
+              rendered[id(m)] = r
+              if i == 0:
+                output.append(r[1])
+              output.append(r[2])
+
+          # Forget families no longer served
+          self.rendered = rendered
+
+        return b''.join(output)
+
+
+class RefreshUnit(object):
+    '''Sections of metrics collected together, and the latest
+    collection of them
+
+    Keyword arguments:
+    sections (List): Names of sections in WorkbookCollector.SECTIONS. None for all.
+    interval (Float): Seconds between collections
+    '''
+
+    def __init__(self, sections, interval):
+        self.sections = sections
+        self.interval = interval
+
+        # Metric families from the last complete collection
+        self.metrics = []
+
+        # Time of the last collection, successful or not
+        self.snapshot_time = None
+
+        # Time of the last successful collection
+        self.last_success_time = None
+
+        # Time of the next collection, and is the unit being collected?
+        self.next_run = 0
+        self.running = False
+
+
+class SnapshotCollector(object):
+    '''Serves the latest collections made by a WorkbookCollector
+
+    Collections are made by background threads, so scrapes of /metrics
+    never wait on Workbook. All sections are collected together every
+    refresh_interval seconds, unless section_intervals is set. Then every
+    section is collected on its own, every number of seconds in
+    section_intervals (Or refresh_interval, if not there), and the latest
+    data from all sections is served together.
+
+    Intervals vary randomly by up to jitter (A fraction of the interval).
+    If semaphore is set, it limits the collections running at a time.
+
+    If snapshot_file is set, the snapshots, and the data the collector
+    keeps between collections, are saved there after every collection,
+    to be loaded on start.
+    '''
+
+    # Metrics on a single collection. Labelled with the section,
+    # when sections are collected on their own.
+    COLLECTION_METRICS = [
+      'workbook_no_of_api_requests',
+      'workbook_scrape_duration_seconds',
+      'workbook_collection_phase_duration_seconds',
+      ]
+
+    def __init__(self, collector, snapshot_file=None, refresh_interval=60,
+        section_intervals={}, jitter=0, semaphore=None):
+        # The collector doing the actual work
+        self.collector = collector
+
+        # File to save the snapshot in. None disables.
+        self.snapshot_file = snapshot_file
+
+        # Max fraction of an interval to add, or subtract, at random
+        self.jitter = jitter
+
+        # Units to collect, with names as keys
+        if section_intervals:
+          self.units = {
+            s:RefreshUnit([s], section_intervals.get(s, refresh_interval))
+            for s in collector.SECTIONS.keys()}
+        else:
+          self.units = {'all': RefreshUnit(None, refresh_interval)}
+
+        # Limits the number of collections running at a time
+        self.semaphore = semaphore or threading.BoundedSemaphore(len(self.units))
+
+        # Copies of the metrics on collections labelled with the unit
+        self.labelled = {name:LabelCache() for name in self.units.keys()}
+
+        # Protects the units
+        self.lock = threading.Lock()
+
+        # Only save one snapshot at a time
+        self.save_lock = threading.Lock()
+
+
+    def describe(self):
+        # Do not trigger a collection when registering
+        return []
+
+
+    def refresh_unit(self, name):
+        '''Collect the sections of unit name, and replace its snapshot'''
+
+        unit = self.units[name]
+        metrics = list(self.collector.collect(unit.sections))
+
+        # Did we get data from Workbook?
+        workbook_up = [m for m in metrics if m.name == 'workbook_up']
+        success = bool(workbook_up) and workbook_up[0].samples[0].value == 1
+
+        with self.lock:
+            unit.snapshot_time = time.time()
+            if success:
+                unit.last_success_time = unit.snapshot_time
+            # Failed sections have the metrics of their last good collection
+            unit.metrics = metrics
+
+        if self.snapshot_file:
+            self.save()
+
+        return success
+
+
+    def refresh(self):
+        '''Collect all units one after the other. Returns True if
+        all data was had from Workbook'''
+        results = [self.refresh_unit(name) for name in self.units.keys()]
+        return all(results)
+
+
+    def save(self):
+        '''Save the snapshot to snapshot_file'''
+
+        with self.save_lock:
+          with self.lock:
+              state = {
+                  'units': {name:{
+                      'metrics': u.metrics,
+                      'snapshot_time': u.snapshot_time,
+                      'last_success_time': u.last_success_time
+                      } for name, u in self.units.items()}
+                  }
+          state['collector'] = self.collector.get_state()
+
+          try:
+              directory = os.path.dirname(self.snapshot_file)
+              if directory:
+                  os.makedirs(directory, exist_ok=True)
+
+              # Write to a temporary file, so a crash never leaves half a snapshot
+              tmp_file = self.snapshot_file + '.tmp'
+              with open(tmp_file, 'wb') as f:
+                  pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+              os.replace(tmp_file, self.snapshot_file)
+          except Exception as e:
+              logging.error("Could not save snapshot to '{}': {}".format(self.snapshot_file, e))
+
+
+    def load(self):
+        '''Load the snapshot from snapshot_file, if any'''
+
+        try:
+            with open(self.snapshot_file, 'rb') as f:
+                state = pickle.load(f)
+            self.collector.set_state(state['collector'])
+        except FileNotFoundError:
+            logging.info("No snapshot in '{}'".format(self.snapshot_file))
+            return False
+        except Exception as e:
+            logging.error("Could not load snapshot from '{}': {}".format(self.snapshot_file, e))
+            return False
+
+        # Snapshots saved before sections could be collected on their own
+        if 'units' not in state:
+            state['units'] = {'all': state}
+
+        with self.lock:
+            for name, u in state['units'].items():
+                unit = self.units.get(name)
+                if unit:
+                    unit.metrics = u['metrics']
+                    unit.snapshot_time = u['snapshot_time']
+                    unit.last_success_time = u['last_success_time']
+
+            snapshot_times = [u.snapshot_time for u in self.units.values() if u.snapshot_time]
+
+        if snapshot_times:
+            logging.info("Loaded snapshot from '{}' collected {:.0f} seconds ago"
+              .format(self.snapshot_file, time.time() - min(snapshot_times)))
+        return True
+
+
+    def next_interval(self, unit):
+        '''Returns the seconds to wait between collections of unit'''
+        return unit.interval * (1 + random.uniform(-self.jitter, self.jitter))
+
+
+    def run_unit(self, name):
+        '''Collect unit name when the semaphore allows it, and
+        schedule the next collection of the unit'''
+        unit = self.units[name]
+        with self.semaphore:
+            start_time = time.time()
+            try:
+                self.refresh_unit(name)
+            except Exception as e:
+                logging.error("Collection of {} in background failed with error: {}"
+                  .format(name, e))
+
+        with self.lock:
+            unit.next_run = start_time + self.next_interval(unit)
+            unit.running = False
+
+
+    def run(self):
+        '''Start collections of units when they are due. Never returns'''
+
+        # Spread the first collections over the jitter
+        now = time.time()
+        with self.lock:
+            for unit in self.units.values():
+                unit.next_run = now + unit.interval * random.uniform(0, self.jitter)
+
+        while True:
+            now = time.time()
+            waits = [1.0]
+            for name, unit in self.units.items():
+                with self.lock:
+                    if unit.running:
+                        continue
+                    if unit.next_run > now:
+                        waits.append(unit.next_run - now)
+                        continue
+                    unit.running = True
+                threading.Thread(target=self.run_unit, args=(name,), daemon=True).start()
+
+            # Wait for the next unit to be due, but check at least every second
+            time.sleep(min(waits))
+
+
+    def start(self):
+        '''Start collecting in background threads'''
+        t = threading.Thread(target=self.run, daemon=True)
+        t.start()
+        return t
+
+
+    def collect(self):
+
+        with self.lock:
+            units = [(name, list(u.metrics), u.snapshot_time, u.last_success_time)
+              for name, u in self.units.items()]
+
+        if len(units) == 1:
+            # Serve the single snapshot as collected
+            for m in units[0][1]:
+                yield m
+        else:
+            # Metrics on the cache and rate limiter shared by the units
+            shared = list(self.collector.collect_shared())
+            shared_names = {m.name for m in shared}
+
+            # Is the latest collection of all units successful?
+            all_up = True
+            for name, metrics, _, _ in units:
+                up = False
+                collection_metrics = []
+                for m in metrics:
+                    if m.name == 'workbook_up':
+                        up = m.samples[0].value == 1
+                    elif m.name in self.COLLECTION_METRICS:
+                        collection_metrics.append(m)
+                    elif m.name in shared_names:
+                        continue
+                    else:
+                        yield m
+                for m in self.labelled[name].label(collection_metrics, 'section', name):
+                    yield m
+                all_up = all_up and up
+
+            for m in shared:
+                yield m
+
+            g = GaugeMetricFamily(
+                'workbook_up', 'Is data beeing pulled from Workbook')
+            g.add_metric([], 1 if all_up else 0)
+            yield g
+
+        # Oldest data served, and last time data was had for all units
+        snapshot_times = [u[2] for u in units]
+        last_success_times = [u[3] for u in units]
+
+        # How old is the data we serve?
+        g = GaugeMetricFamily(
+            'workbook_snapshot_age_seconds',
+            'Seconds since the served data was collected from Workbook')
+        if all(snapshot_times):
+            g.add_metric([], time.time() - min(snapshot_times))
+        yield g
+
+        # When did we last get all data from Workbook?
+        g = GaugeMetricFamily(
+            'workbook_last_success_timestamp_seconds',
+            'Unix time of last successful collection from Workbook')
+        if all(last_success_times):
+            g.add_metric([], min(last_success_times))
+        yield g
+
+
+class CoalescingCollector(object):
+    '''Collects from a WorkbookCollector when scraped. Scrapes arriving
+    while a collection is in progress, wait for it and are served the
+    same metrics, so concurrent scrapes only make one collection
+    (Single-flight). If a scrape waits more than max_wait seconds, it is
+    served the latest complete collection instead.
+
+    Keyword arguments:
+    collector (WorkbookCollector): The collector doing the actual work
+    max_wait (Float): Max seconds to wait for a collection made for another scrape. 0 for no limit.
+    '''
+
+    def __init__(self, collector, max_wait=0):
+        # The collector doing the actual work
+        self.collector = collector
+
+        self.max_wait = max_wait
+
+        # Future with the metrics of the collection in progress. None if idle.
+        self.future = None
+
+        # Metrics of the latest complete collection
+        self.metrics = None
+
+        # Scrapes served the collection of another scrape, and
+        # scrapes served the latest collection after waiting too long
+        self.no_of_coalesced = 0
+        self.no_of_stale = 0
+
+        # Protects the attributes above
+        self.lock = threading.Lock()
+
+
+    def describe(self):
+        # Do not trigger a collection when registering
+        return []
+
+
+    def collect_metrics(self):
+        '''Returns a list of the metrics of a new collection, or of the
+        collection in progress'''
+
+        with self.lock:
+          f = self.future
+          owner = f is None
+          if owner:
+            f = self.future = concurrent.futures.Future()
+          else:
+            self.no_of_coalesced += 1
+          latest = self.metrics
+
+        if owner:
+          try:
+            metrics = list(self.collector.collect())
+          except Exception as e:
+            with self.lock:
+              self.future = None
+            f.set_exception(e)
+            raise
+          with self.lock:
+            self.metrics = metrics
+            self.future = None
+          f.set_result(metrics)
+          return metrics
+
+        # Only stop waiting, if there is something else to serve
+        timeout = self.max_wait if self.max_wait and latest is not None else None
+        try:
+          return f.result(timeout=timeout)
+        except concurrent.futures.TimeoutError:
+          logging.warning("Collection in progress took more than {} seconds. Serving the latest collection"
+            .format(self.max_wait))
+          with self.lock:
+            self.no_of_stale += 1
+          return latest
+
+
+    def collect(self):
+        for m in self.collect_metrics():
+            yield m
+
+        with self.lock:
+            no_of_coalesced = self.no_of_coalesced
+            no_of_stale = self.no_of_stale
+
+        c = CounterMetricFamily(
+            'workbook_coalesced_scrapes',
+            'Scrapes served the collection made for another scrape in progress')
+        c.add_metric([], no_of_coalesced)
+        yield c
+
+        c = CounterMetricFamily(
+            'workbook_stale_scrapes',
+            'Scrapes served the latest collection, because the one in progress took too long')
+        c.add_metric([], no_of_stale)
+        yield c
+
+
+class TenantsCollector(object):
+    '''Collects from the collectors of more than one Workbook (Tenant)
+    in parallel. Label 'tenant' is added to all metrics.
+
+    Keyword arguments:
+    collectors (Dict): Collectors with tenant names as keys
+    '''
+
+    def __init__(self, collectors):
+        self.collectors = collectors
+
+        # Copies of the metrics labelled with the tenant
+        self.labelled = {t:LabelCache() for t in collectors.keys()}
+
+        # A thread pr. tenant, so a slow tenant does not hold up the rest
+        self.pool = concurrent.futures.ThreadPoolExecutor(
+          max_workers=len(collectors))
+
+
+    def describe(self):
+        # The metrics depend on the data in Workbook
+        return []
+
+
+    def collect_tenant(self, tenant):
+        '''Returns a list of the metrics for tenant'''
+        return self.labelled[tenant].label(
+          self.collectors[tenant].collect(), 'tenant', tenant)
+
+
+    def collect(self):
+        futures = {t:self.pool.submit(self.collect_tenant, t)
+          for t in self.collectors.keys()}
+
+        for tenant, f in futures.items():
+          try:
+            yield from f.result()
+          except Exception as e:
+            logging.error("Could not collect metrics for tenant {} with error: {}"
+              .format(tenant, e))
+
+
+class FileSink(object):
+    '''Appends deltas of changed series to a file, a line of JSON pr.
+    delta. The file is opened for every delta, so it can be rotated.
+
+    Keyword arguments:
+    path (String): The file to append to
+    '''
+
+    name = 'file'
+
+    def __init__(self, path):
+        self.path = path
+
+
+    def send(self, line):
+        with open(self.path, 'ab') as f:
+          f.write(line)
+
+
+class SocketSink(object):
+    '''Sends deltas of changed series to all clients connected to a Unix
+    socket, a line of JSON pr. delta. Clients only get the deltas sent
+    after they connect. Clients not reading within timeout seconds
+    are disconnected.
+
+    Keyword arguments:
+    path (String): The path of the socket to listen on
+    timeout (Float): Max seconds to wait for a client to read a delta
+    '''
+
+    name = 'socket'
+
+    def __init__(self, path, timeout=10):
+        self.path = path
+        self.timeout = timeout
+
+        # Connected clients
+        self.clients = []
+        self.lock = threading.Lock()
+
+        # Remove the socket left by an exporter no longer running
+        try:
+          if stat.S_ISSOCK(os.stat(path).st_mode):
+            os.unlink(path)
+        except FileNotFoundError:
+          pass
+
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(path)
+        self.server.listen()
+
+        threading.Thread(target=self.accept, daemon=True).start()
+
+
+    def accept(self):
+        '''Accept clients connecting to the socket. Runs in a thread.'''
+        while True:
+          try:
+            client, _ = self.server.accept()
+          except OSError as e:
+            logging.error("Could not accept client on socket '{}': {}".format(self.path, e))
+            time.sleep(1)
+            continue
+          client.settimeout(self.timeout)
+          with self.lock:
+            self.clients.append(client)
+          logging.info("Client connected to change stream on socket '{}'".format(self.path))
+
+
+    def send(self, line):
+        with self.lock:
+          clients = list(self.clients)
+
+        for client in clients:
+          try:
+            client.sendall(line)
+          except OSError as e:
+            logging.info("Disconnecting client from change stream on socket '{}': {}"
+              .format(self.path, e))
+            client.close()
+            with self.lock:
+              self.clients.remove(client)
+
+
+class WebhookSink(object):
+    '''Posts deltas of changed series to a URL as JSON
+
+    Keyword arguments:
+    url (String): The URL to post to
+    timeout (Float): Max seconds to wait for the response
+    '''
+
+    name = 'webhook'
+
+    def __init__(self, url, timeout=10):
+        self.url = url
+        self.timeout = timeout
+        self.session = requests.Session()
 
-            # Run through dict of current prices
-            for e_id, e_prices in prices_dict.items():
 
-                # company list
-                try:
-                  # The employee
-                  e = employees[e_id]
-                  # Employee's company
-                  c_id = e['CompanyId']
-                  # Employees's department
-                  d_id = e['DepartmentId']
-                except KeyError:
-                  # Abort because employee ID from price is not
-                  # in employees (Not employed at company we report for)
-                  # (Can not filter on companies for prices)
-                  continue
+    def send(self, line):
+        r = self.session.post(self.url, data=line, timeout=self.timeout,
+          headers={'Content-Type': 'application/json'})
+        r.raise_for_status()
 
-                # Don't process users not registering time
-                if not e['TimeRegistration']:
-                  logging.debug("Ignoring user {} when reporting employee prices"
-                    .format(e['EmployeeName']))
-                  continue
 
-                # Add department dict if needed
-                if d_id not in price_dict[c_id]:
-                  price_dict[c_id][d_id] = {}
+class ChangePublisher(object):
+    '''Sends deltas of changed series to sinks, from a thread of its own,
+    so slow sinks do not hold up collections. Deltas are dropped if more
+    than max_queue deltas are waiting to be sent.
 
-                # Add employees prices to dict
-                price_dict[c_id][d_id][e_id] = e_prices
+    Keyword arguments:
+    sinks (List): Sinks (Like FileSink) to send every delta to
+    full_interval (Float): Seconds between deltas with all series. 0 for only the first.
+    max_queue (Int): Max number of deltas waiting to be sent
+    '''
 
-            # Loop through company price dicts
-            for c_id, c_prices in price_dict.items():
-                for d_id, d_prices in c_prices.items():
-                    currency_id = companies[c_id]['CurrencyId']
-                    currency = self.currencies[currency_id]
-                    d_name = departments[d_id]['Name']
+    def __init__(self, sinks, full_interval=3600, max_queue=100):
+        self.sinks = sinks
+        self.full_interval = full_interval
 
-                    # Store observations for company here
-                    observations = {
-                      'Profit': [],
-                      'HoursCost': [],
-                      'HoursSale': []
-                      }
+        # Deltas waiting to be sent, as lines of JSON
+        self.queue = queue.Queue(maxsize=max_queue)
 
-                    # Loop price data, and add to observations dicts
-                    for e_id, p in d_prices.items():
-                      for field in observations.keys():
+        # Deltas dropped, and deltas failing pr. sink
+        self.no_of_dropped = 0
+        self.no_of_errors = collections.Counter()
+        self.lock = threading.Lock()
 
-                        # Making sure these reduntant dict are the same
-                        assert p['HoursCost'] == prices_dict[e_id]['HoursCost']
+        threading.Thread(target=self.run, daemon=True).start()
 
-                        # Add observation if present
-                        try:
-                          observations[field].append(p[field])
-                        except KeyError as e:
-                          observations[field].append(0.0)
-                          logging.warning("Missing key {} for employee '{}'. Inserted 0.0"
-                            .format(e, employees[p['EmployeeId']]['EmployeeName']))
 
-                    # PROFIT #
-                    yield build_histogram(
-                      observations['Profit'],
-                      profit_buckets,
-                      'workbook_employees_profit_ratio',
-                      'Estimated profit on 1 hours work',
-                      ['company_id', 'department_id', 'department_name'],
-                      [str(c_id), str(d_id), d_name])
+    def describe(self):
+        return []
 
-                    # HOURS SALE #
-                    yield build_histogram(
-                      observations['HoursSale'],
-                      hours_sale_buckets,
-                      'workbook_employees_hours_sale',
-                      'Estimated sales price of 1 hours work',
-                      ['company_id', 'department_id', 'department_name', 'currency'],
-                      [str(c_id), str(d_id), d_name, currency])
 
-                    # HOURS COST #
-                    yield build_histogram(
-                      observations['HoursCost'],
-                      hours_cost_buckets,
-                      'workbook_employees_hours_cost',
-                      'Estimated cost of 1 hours work',
-                      ['company_id', 'department_id', 'department_name', 'currency'],
-                      [str(c_id), str(d_id), d_name, currency])
+    def publish(self, delta):
+        '''Queue delta (A dict) for sending to the sinks'''
+        line = json.dumps(delta, separators=(',', ':')).encode() + b'\n'
+        try:
+          self.queue.put_nowait(line)
+        except queue.Full:
+          logging.error("Dropping delta of changed series, as {} deltas are waiting to be sent"
+            .format(self.queue.maxsize))
+          with self.lock:
+            self.no_of_dropped += 1
 
 
-        # EMPLOYEES DAYS EMPLOYED #
-        for company_id in companies.keys():
+    def run(self):
+        '''Send the queued deltas to the sinks. Runs in a thread.'''
+        while True:
+          line = self.queue.get()
+          for sink in self.sinks:
             try:
-                # Get active employees
-                employees = self.wb.get_employees(Active=True,CompanyId=company_id)
-                no_of_wb_requests += 1
+              sink.send(line)
             except Exception as e:
-                print("Could not get WB employees with error: {}".format(e))
-                wb_error = True
-            else:
-                # Gather observations (Days since employment)
-                observations = []
-                for e in employees:
-                    observations.append((datetime.today() - parse_date(e['HireDate'])).days)
-                
-                # Job age histogram (Non billable)
-                yield build_histogram(
-                   observations,
-                   days_employed_buckets,
-                   'workbook_employees_days_employed',
-                   'Days since employment',
-                   ['company_id'],
-                   [str(company_id)])
+              logging.error("Could not send delta of changed series to {} sink: {}"
+                .format(sink.name, e))
+              with self.lock:
+                self.no_of_errors[sink.name] += 1
 
 
-        # FIXME: Add config with costumers to ignore (Pseudo costumers)
-        # FIXME: Active clients pr. department
-        # JOBS #
-        for company_id in companies.keys():
-            try:
-                # Get active jobs
-                jobs = self.wb.get_jobs(Status=ACTIVE_JOBS, CompanyId=company_id)
-                no_of_wb_requests += 1
-            except Exception as e:
-                logging.error("Could not get WB jobs with error: {}".format(e))
-                wb_error = True
-            else:
-                # Gather observations (Days since employment)
-                observations = {
-                    'billable': [],
-                    'non_billable': [],
-                    'status_id_billable': [],
-                    'status_id': []
-                    }
-                active_clients = {
-                    'billable': set(),
-                    'non_billable': set()
-                    }
-                #no_of_billable_jobs = 0
-                for j in jobs:
-                    # Time job was created
-                    date_created = parse_date(j.get('CreateDate'))
-                    # End date for job
-                    date_end = parse_date(j.get('EndDate'))
-                    # Days since job was created
-                    job_age = (datetime.today() - date_created).days
-
-                    if j.get('Billable'):
-                        observations['billable'].append(job_age)
-                        active_clients['billable'].add(j['CustomerId'])
-                        observations['status_id_billable'].append(j['StatusId'])
-                    else:
-                        observations['non_billable'].append(job_age)
-                        active_clients['non_billable'].add(j['CustomerId'])
-
-                    observations['status_id'].append(j['StatusId'])
-
-                # Job status histogram (billable)
-                yield build_histogram(
-                   observations['status_id_billable'],
-                   ACTIVE_JOBS,
-                   'workbook_jobs_status_billable',
-                   'Status of billable jobs',
-                   ['company_id'],
-                   [str(company_id)])
-
-                # Job status histogram (Total)
-                yield build_histogram(
-                   observations['status_id'],
-                   ACTIVE_JOBS,
-                   'workbook_jobs_status_total',
-                   'Status of all jobs',
-                   ['company_id'],
-                   [str(company_id)])
-
-                # Job age histogram (billable)
-                yield build_histogram(
-                   observations['billable'],
-                   JOB_AGE_BUCKETS,
-                   'workbook_jobs_age_days',
-                   'Days since job was created',
-                   ['company_id', 'billable'],
-                   [str(company_id), '1'])
-
-                # Job age histogram (Non billable)
-                yield build_histogram(
-                   observations['non_billable'],
-                   JOB_AGE_BUCKETS,
-                   'workbook_jobs_age_days',
-                   'Days since job was created',
-                   ['company_id', 'billable'],
-                   [str(company_id), '0'])
-
-                cust_billable = GaugeMetricFamily(
-                    'workbook_active_customers_billable_jobs',
-                    'No of unique customers for billable active jobs',
-                    labels=["company_id"])
-                cust_billable.add_metric(
-                    [str(company_id)],
-                    len(active_clients['billable']))
-                yield cust_billable
-
-                cust_total = GaugeMetricFamily(
-                    'workbook_active_customers_total_jobs',
-                    'No of unique customers for all active jobs',
-                    labels=["company_id"])
-                cust_total.add_metric(
-                  [str(company_id)],
-                  len(active_clients['non_billable'].union(active_clients['billable']))
-                  )
-                yield cust_total
-
-                # Active client age
-                # Billable
-                client_age_billable = []
-                for c_id in list(active_clients['billable']):
-                  c = self.wb.get_costumers(costumer_id=c_id)
-                  no_of_wb_requests += 1
-                  # Observe WonDate
-                  if c.get('WonDate'):
-                    won_date = parse_date(c.get('WonDate'))
-                    client_age_billable.append((datetime.today() - won_date).days)
-                  else:
-                    # Client has no WonDate?
-                    logging.warning("Customer {} with billable job has no 'WonDate' in Workbook".format(c['Name']))
-
-                # Client age histogram (billable)
-                yield build_histogram(
-                   client_age_billable,
-                   CLIENT_AGE_BUCKETS,
-                   'workbook_active_customers_age_days',
-                   'Days since client was created',
-                   ['company_id', 'billable'],
-                   [str(company_id), '1'])
-
-                # Non billable
-                client_age_non_billable = []
-                for c_id in list(active_clients['non_billable']):
-                  c = self.wb.get_costumers(costumer_id=c_id)
-                  no_of_wb_requests += 1
-                  # Observe WonDate
-                  if c.get('WonDate'):
-                    won_date = parse_date(c.get('WonDate'))
-                    client_age_non_billable.append((datetime.today() - won_date).days)
-                  else:
-                    # Client has no WonDate?
-                    logging.warning("Customer {} with non billable job has no 'WonDate' in Workbook".format(c['Name']))
-
-                # Client age histogram (Non billable)
-                yield build_histogram(
-                   client_age_non_billable,
-                   CLIENT_AGE_BUCKETS,
-                   'workbook_active_customers_age_days',
-                   'Days since client was created',
-                   ['company_id', 'billable'],
-                   [str(company_id), '0'])
+    def collect(self):
+        with self.lock:
+          no_of_dropped = self.no_of_dropped
+          no_of_errors = dict(self.no_of_errors)
+
+        c = CounterMetricFamily(
+          'workbook_change_deltas_dropped',
+          'Deltas of changed series dropped, because too many were waiting to be sent')
+        c.add_metric([], no_of_dropped)
+        yield c
+
+        c = CounterMetricFamily(
+          'workbook_change_sink_errors',
+          'Deltas of changed series which could not be sent to the sink',
+          labels=['sink'])
+        for sink in self.sinks:
+          c.add_metric([sink.name], no_of_errors.get(sink.name, 0))
+        yield c
+
+
+class ChangeStream(object):
+    '''Compares the metrics of every collection made by a WorkbookCollector
+    with the previous collection, and publishes the series (Samples) which
+    changed or were removed as a delta. Sections not changed since the
+    last collection (The same list of metrics) are not compared.
+
+    The first delta, and a delta every full_interval seconds of the
+    publisher, has all series, and 'full' set to true. Deltas are numbered
+    by 'seq', so consumers missing a delta can wait for the next full one.
 
-        # CREDIT #
-        try:
-            # Get all creditors accross companies
-            #creditors = self.wb.get_creditors()
-            pass
-        except Exception as e:
-            print("Error: {}".format(e))
-            wb_error = True
-        else:
-            for company_id in companies.keys():
-                # Get currency
-                currency_id = companies[company_id]['CurrencyId']
-                currency = self.currencies[currency_id]
+    Keyword arguments:
+    publisher (ChangePublisher): Sends the deltas
+    tenant (String): Name of the tenant, added to the deltas. None if not a tenant.
+    '''
 
-                # Store credit observations here
-                observations = {
-                    'total': [],
-                    'due': [],
-                    }
-                # Run through creditors for current company
-                for c in creditors.values():
-                    if c['CompanyId'] == company_id and c.get('CurrencyId') and c.get('RemainingAmountTotal'):
+    def __init__(self, publisher, tenant=None):
+        self.publisher = publisher
+        self.tenant = tenant
+
+        # Values of the series of the last collection of every
+        # section, and the list of metrics they are from
+        self.series = {}
+        self.sources = {}
+
+        # Number of the last delta, and time of the last full delta
+        self.seq = 0
+        self.last_full_time = None
+
+        # Deltas published, and series changed and removed
+        self.no_of_deltas = 0
+        self.no_of_series = collections.Counter()
+
+        self.lock = threading.Lock()
+
+
+    def update(self, sections):
+        '''Publish the series changed since the last collection
+
+        Keyword arguments:
+        sections (Dict): Section names as keys, and lists of metrics collected as values
+        '''
+
+        now = time.time()
+        full_interval = self.publisher.full_interval
+
+        with self.lock:
+          full = self.last_full_time is None or \
+            (full_interval and now - self.last_full_time >= full_interval)
+
+          changed = []
+          removed = []
+          for section, metrics in sections.items():
+            if not full and self.sources.get(section) is metrics:
+              continue
+
+            old = self.series.get(section, {})
+            new = {}
+            for m in metrics:
+              for sample in m.samples:
+                key = (sample.name, tuple(sorted(sample.labels.items())))
+                new[key] = sample.value
+                if full or old.get(key) != sample.value:
+                  changed.append([sample.name, sample.labels, sample.value])
+            if not full:
+              removed.extend([name, dict(labels)] for name, labels in old.keys()
+                if (name, labels) not in new)
+
+            self.series[section] = new
+            self.sources[section] = metrics
+
+          if full:
+            self.last_full_time = now
+            # Series of sections no longer collected
+            for section in set(self.series.keys()) - set(sections.keys()):
+              for name, labels in self.series[section].keys():
+                changed.append([name, dict(labels), self.series[section][(name, labels)]])
+          elif not changed and not removed:
+            return
 
-                        total = c.get('RemainingAmountTotal', None)
-                        due = c.get('RemainingAmountDue', None)
-                        c_id = c.get('CurrencyId')
+          self.seq += 1
+          delta = {'seq': self.seq, 'timestamp': now, 'full': bool(full)}
+          if self.tenant is not None:
+            delta['tenant'] = self.tenant
+          delta['changed'] = changed
+          delta['removed'] = removed
 
-                        if due:
-                            observations['due'].append(due)
+          self.no_of_deltas += 1
+          self.no_of_series['changed'] += len(changed)
+          self.no_of_series['removed'] += len(removed)
 
-                        if total:
-                            observations['total'].append(total)
+        self.publisher.publish(delta)
 
 
-                # Report metrics if no errors in WB
-                if not wb_error:
-                    # Credit total
-                    yield build_histogram(
-                       observations['total'],
-                       credit_buckets,
-                       'workbook_credit_total',
-                       'Amount owed',
-                       ['company_id', 'currency'],
-                       [str(company_id), currency])
+    def collect(self):
+        with self.lock:
+          no_of_deltas = self.no_of_deltas
+          no_of_series = dict(self.no_of_series)
 
-                    # Credit due
-                    yield build_histogram(
-                       observations['due'],
-                       credit_buckets,
-                       'workbook_credit_due',
-                       'Amount owed',
-                       ['company_id', 'currency'],
-                       [str(company_id), currency])
+        c = CounterMetricFamily(
+          'workbook_change_deltas',
+          'Deltas of changed series published')
+        c.add_metric([], no_of_deltas)
+        yield c
 
-        # DEBIT #
-        for company_id in companies.keys():
-            # Get currency
-            currency_id = companies[company_id]['CurrencyId']
-            currency = self.currencies[currency_id]
-            try:
-                debtors = self.wb.get_debtors_balance(company_id=company_id)
-                no_of_wb_requests += 1
-            except Exception as e:
-                print("Error: {}".format(e))
-                wb_error = True
-            else:
-                observations = {
-                    'total': [],
-                    'due': [],
-                    }
-                # Run through creditors for current company
-                for d in debtors:
-                    c_id = d.get('CurrencyId', False)
-                    if c_id:
-                        total = d.get('RemainingAmountTotal', None)
-                        due = d.get('RemainingAmountDue', None)
+        c = CounterMetricFamily(
+          'workbook_change_series',
+          'Series changed or removed in the deltas published',
+          labels=['change'])
+        for change in ['changed', 'removed']:
+          c.add_metric([change], no_of_series.get(change, 0))
+        yield c
 
-                        if due:
-                            observations['due'].append(due)
 
-                        if total:
-                            observations['total'].append(total)
+# Only one profiler can run at a time
+PROFILE_LOCK = threading.Lock()
 
-                # Report metrics if no errors from WB
-                if not wb_error:
-                  # Debit total
-                  yield build_histogram(
-                     observations['total'],
-                     debit_buckets,
-                     'workbook_debit_total',
-                     'Debit total',
-                     ['company_id', 'currency'],
-                     [str(company_id), currency])
-  
-                  # Debit due
-                  yield build_histogram(
-                     observations['due'],
-                     debit_buckets,
-                     'workbook_debit_due',
-                     'Debit due',
-                     ['company_id', 'currency'],
-                     [str(company_id), currency])
+def profile_collection(collector, cycles=1, limit=30):
+    '''Collect all metrics from Workbook cycles times under cProfile,
+    while tracing memory allocations with tracemalloc.
 
-        # How many requests did we make to the Workbook API?
-        g = GaugeMetricFamily(
-            'workbook_no_of_api_requests',
-            'Number of requests to Workbook performed during scrape')
-        g.add_metric([], no_of_wb_requests)
-        yield g
+    Only the calling thread is profiled. Time spent in the pool of workers
+    shows up as time waiting for them. Allocations are traced in all threads.
 
-        scrape_time_seconds = (datetime.now()-scrape_start_time).seconds
-        # How long did the scape take?
-        g = GaugeMetricFamily(
-            'workbook_scrape_duration_seconds',
-            'Number of seconds it took to perform scrape')
-        g.add_metric([], scrape_time_seconds)
-        yield g
+    Returns a report in text, with the functions taking the most time, and
+    the lines allocating the most memory.
 
+    Keyword arguments:
+    collector (WorkbookCollector): The collector to profile
+    cycles (Int): Number of collections to profile
+    limit (Int): Number of functions and lines to list
+    '''
 
-        # Problems getting data from workbook?
-        if wb_error:
-            workbook_up.add_metric([], 0)
-        else:
-            workbook_up.add_metric([], 1)
-        yield workbook_up
+    with PROFILE_LOCK:
+      profiler = cProfile.Profile()
+
+      # Leave tracemalloc running, if started by someone else
+      tracing = tracemalloc.is_tracing()
+      if not tracing:
+        tracemalloc.start()
+      tracemalloc.reset_peak()
+      before = tracemalloc.take_snapshot()
+
+      start_time = time.monotonic()
+      try:
+        for _ in range(cycles):
+          profiler.enable()
+          try:
+            for _ in collector.collect():
+              pass
+          finally:
+            profiler.disable()
+        duration = time.monotonic() - start_time
+        current, peak = tracemalloc.get_traced_memory()
+        after = tracemalloc.take_snapshot()
+      finally:
+        if not tracing:
+          tracemalloc.stop()
+
+    report = io.StringIO()
+    report.write("Profile of {} collection(s) taking {:.2f} seconds\n\n"
+      .format(cycles, duration))
+
+    stats = pstats.Stats(profiler, stream=report)
+    stats.sort_stats('cumulative').print_stats(limit)
+    stats.sort_stats('tottime').print_stats(limit)
+
+    report.write("Memory traced: {:.1f} KiB, peak {:.1f} KiB\n\n"
+      .format(current / 1024, peak / 1024))
+    report.write("Lines allocating the most memory during the collection(s):\n")
+    for difference in after.compare_to(before, 'lineno')[:limit]:
+      report.write("{}\n".format(difference))
+
+    return report.getvalue()
+
+
+class ExporterMetricsHandler(MetricsHandler):
+    '''Serves metrics with one family pr. name, rendered by an
+    ExpositionCache in the text format. If collectors is set, a profile
+    of collections is served at /debug/profile?cycles=1&tenant=name
+    (Tenant only needed with more than one).
+    '''
 
+    # Renders the metrics in the text format
+    exposition = None
 
+    # WorkbookCollectors to profile, with tenant names as keys. None disables.
+    collectors = None
+
+    # Max collections to profile pr. request
+    max_cycles = 10
+
+    def do_GET(self):
+        url = urllib.parse.urlparse(self.path)
+        params = urllib.parse.parse_qs(url.query)
+
+        if url.path == '/debug/profile' and self.collectors:
+          return self.do_profile(params)
+
+        registry = self.registry
+        if 'name[]' in params:
+          registry = registry.restricted_registry(params['name[]'])
+        encoder, content_type = choose_encoder(self.headers.get('Accept'))
+        try:
+          if encoder is generate_latest:
+            output = self.exposition.render(registry.collect())
+          else:
+            # OpenMetrics
+            output = encoder(types.SimpleNamespace(
+              collect=lambda: merge_families(registry.collect())))
+        except:
+          self.send_error(500, 'error generating metric output')
+          raise
+
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.end_headers()
+        self.wfile.write(output)
+
+
+    def do_profile(self, params):
+        '''Serve a profile of collections'''
+        try:
+          cycles = int(params.get('cycles', ['1'])[0])
+          if not 0 < cycles <= self.max_cycles:
+            raise ValueError
+        except ValueError:
+          self.send_error(400, "cycles must be a number from 1 to {}".format(self.max_cycles))
+          return
+
+        tenant = params.get('tenant', [None])[0]
+        if tenant is None and len(self.collectors) == 1:
+          tenant = list(self.collectors.keys())[0]
+        if tenant not in self.collectors:
+          self.send_error(400, "tenant must be one of: {}".format(
+            ", ".join(sorted(self.collectors.keys()))))
+          return
+
+        logging.info("Profiling {} collection(s) of tenant '{}'".format(cycles, tenant))
+        try:
+          output = profile_collection(self.collectors[tenant], cycles).encode('utf-8')
+        except Exception as e:
+          logging.error("Profiling failed with error: {}".format(e))
+          self.send_error(500, 'error profiling collection')
+          return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; charset=utf-8')
+        self.end_headers()
+        self.wfile.write(output)
 
-        if wb_error:
-          logging.error("Error exporting data from workbook")
-        else:
-          logging.info("Scrape finished in {} seconds with {} requests to Workbook API"
-            .format(scrape_time_seconds, no_of_wb_requests))
+
+def start_exporter_http_server(port, collectors=None, registry=REGISTRY):
+    '''Like prometheus_client.start_http_server(), but serving the metrics
+    with ExporterMetricsHandler
+
+    Keyword arguments:
+    port (Int): The port to listen on
+    collectors (Dict): WorkbookCollectors to profile with tenant names as keys. None disables.
+    registry (CollectorRegistry): The metrics to serve
+    '''
+    handler = type('ExporterMetricsHandler', (ExporterMetricsHandler,), {
+      'registry': registry,
+      'exposition': ExpositionCache(),
+      'collectors': collectors
+      })
+    httpd = http.server.ThreadingHTTPServer(('', port), handler)
+    t = threading.Thread(target=httpd.serve_forever)
+    t.daemon = True
+    t.start()
 
 
 def parse_args():
@@ -1001,6 +4259,33 @@ def parse_args():
         help="Specify to disable logging to file."
     )
 
+    # Profile collections, write the report and exit
+    parser.add_argument(
+        '--profile',
+        metavar='FILE',
+        required=False,
+        help='Profile collections from Workbook, write the report to FILE and exit.',
+        default=None
+    )
+
+    # Collections to profile with --profile
+    parser.add_argument(
+        '--profile-cycles',
+        metavar=1,
+        required=False,
+        type=int,
+        help='Number of collections to profile with --profile.',
+        default=1
+    )
+
+    # Serve profiles on /debug/profile. Default false
+    parser.add_argument(
+        "--enable-debug-profile",
+        # True if specified, False otherwise
+        action='store_true',
+        help="Specify to serve profiles of collections on /debug/profile."
+    )
+
     return parser.parse_args()
 
 
@@ -1019,6 +4304,290 @@ def parse_config(config_file):
   return config_dict
 
 
+def tenant_configs(config):
+    '''Returns a dict with tenant names as keys, and the config for the
+    tenant as values. Settings in the sections of a tenant replace the
+    settings in the same sections at the top of the config file.
+
+    Keyword arguments:
+    config (Dict): The content of the config file
+    '''
+
+    tenants = config.get('tenants')
+    if not isinstance(tenants, list) or not tenants:
+      raise ValueError("Value tenants is not a list in config file")
+
+    configs = {}
+    for t in tenants:
+      name = t.get('name') if isinstance(t, dict) else None
+      if not isinstance(name, str) or not name:
+        raise ValueError("Value name is missing for a tenant in config file")
+      if name in configs:
+        raise ValueError("Tenant {} is listed more than once in config file".format(name))
+
+      configs[name] = {
+        section: dict(config.get(section) or {}, **(t.get(section) or {}))
+        for section in TENANT_SECTIONS}
+
+      if not configs[name]['workbook'].get('url'):
+        raise ValueError("Value url is missing for tenant {} in config file".format(name))
+
+    # Tenants saving snapshots to the same file would overwrite each other
+    snapshot_files = [c['exporter']['snapshot_file'] for c in configs.values()
+      if c['exporter'].get('snapshot_file')]
+    if len(snapshot_files) != len(set(snapshot_files)):
+      raise ValueError("Value snapshot_file is the same for more than one tenant in config file")
+
+    return configs
+
+
+def make_change_publisher(config):
+    '''Returns a publisher of the series changed by collections, sending
+    them to the sinks in section changes of config. None if there are no
+    sinks.
+
+    Keyword arguments:
+    config (Dict): The content of the config file
+    '''
+
+    changes_config = config.get('changes') or {}
+    if not isinstance(changes_config, dict):
+      raise ValueError("Value changes is not a dictionary in config file")
+
+    # Seconds to wait for a sink
+    timeout = changes_config.get('timeout', 10)
+    if not isinstance(timeout, (int, float)) or timeout <= 0:
+      raise ValueError("Value timeout in section changes is not a positive number in config file")
+
+    # Seconds between deltas with all series
+    full_interval = changes_config.get('full_interval', 3600)
+    if not isinstance(full_interval, (int, float)) or full_interval < 0:
+      raise ValueError("Value full_interval in section changes is not a positive number in config file")
+
+    for key in ['file', 'socket', 'webhook']:
+      if not isinstance(changes_config.get(key, ''), str):
+        raise ValueError("Value {} in section changes is not a string in config file".format(key))
+
+    sinks = []
+    if changes_config.get('file'):
+      sinks.append(FileSink(changes_config['file']))
+    if changes_config.get('socket'):
+      sinks.append(SocketSink(changes_config['socket'], timeout))
+    if changes_config.get('webhook'):
+      sinks.append(WebhookSink(changes_config['webhook'], timeout))
+
+    if not sinks:
+      return None
+
+    logging.info("Publishing changed series to sinks: {}"
+      .format(", ".join(sink.name for sink in sinks)))
+    return ChangePublisher(sinks, full_interval)
+
+
+def make_workbook_collector(config, wb_url, wb_user, wb_password, limiter=None,
+    changes=None):
+    '''Returns a WorkbookCollector for the Workbook configured in config
+
+    Keyword arguments:
+    config (Dict): Config with sections workbook, cache and time_entries
+    wb_url (String): Server url for the Workbook API
+    wb_user (String): User name for logging in to Workbook
+    wb_password (String): Password for logging in to Workbook
+    limiter (RateLimiter): Limits the requests to Workbook. Made from config if None.
+    changes (ChangeStream): Publishes the series changed by every collection. None disables.
+    '''
+
+    # Jobs with these states are considered active
+    active_jobs = config['workbook'].get('active_jobs', [0,1,2,3])
+    if not isinstance(active_jobs, list):
+      raise ValueError("Active job states is not a list")
+
+    # Only get data on these companies. If empty list,
+    # get data for all companies in Workbook
+    companies = config['workbook'].get('companies', [])
+    if not isinstance(companies, list):
+      raise ValueError("Value companies is not a list in config file")
+
+    finance_account_types = config['workbook'].get('finance_account_types', [3])
+    if not isinstance(finance_account_types, list):
+      raise ValueError("Value finance_account_types is not a list in config file")
+
+    # Number of calls to Workbook to run in parallel
+    workers = config['workbook'].get('workers', 8)
+    if not isinstance(workers, int) or workers < 1:
+      raise ValueError("Value workers is not a positive integer in config file")
+
+    # Number of processes collecting sections pr. company.
+    # If 0, sections are collected in the exporter process.
+    aggregation_processes = config['workbook'].get('aggregation_processes', 0)
+    if isinstance(aggregation_processes, bool) or \
+      not isinstance(aggregation_processes, int) or aggregation_processes < 0:
+      raise ValueError("Value aggregation_processes is not a positive integer in config file")
+
+    # Max seconds to wait for a single call to Workbook
+    request_timeout = config['workbook'].get('request_timeout', 60)
+    if not isinstance(request_timeout, (int, float)) or request_timeout <= 0:
+      raise ValueError("Value request_timeout is not a positive number in config file")
+
+    # Limit the requests to Workbook, and retry failed requests
+    limiter_settings = {}
+    for key, value_types, minimum, default in [
+      ('rate_limit', (int, float), 0, 0),
+      ('rate_burst', int, 1, 10),
+      ('max_concurrent_requests', int, 0, 0),
+      ('retries', int, 0, 2),
+      ('retry_backoff', (int, float), 0, 0.5),
+      ('target_latency', (int, float), 0, 0)]:
+      value = config['workbook'].get(key, default)
+      if isinstance(value, bool) or not isinstance(value, value_types) or value < minimum:
+        raise ValueError("Value {} is not a number of at least {} in config file"
+          .format(key, minimum))
+      limiter_settings[key] = value
+
+    # Only a rate limit can be lowered when Workbook is slow
+    if limiter_settings['target_latency'] and not limiter_settings['rate_limit']:
+      raise ValueError("Value target_latency is set without rate_limit in config file")
+
+    if not limiter:
+      limiter = RateLimiter(
+        rate=limiter_settings['rate_limit'],
+        burst=limiter_settings['rate_burst'],
+        max_concurrent=limiter_settings['max_concurrent_requests'],
+        retries=limiter_settings['retries'],
+        backoff=limiter_settings['retry_backoff'],
+        target_latency=limiter_settings['target_latency'])
+
+    # Get data from Workbook using a pool of threads or asyncio
+    engine = config['workbook'].get('engine', 'threads')
+    if engine not in ['threads', 'asyncio']:
+      raise ValueError("Value engine is not one of 'threads' or 'asyncio' in config file")
+    if engine == 'asyncio' and not aiohttp:
+      raise ValueError("Module aiohttp is needed for engine 'asyncio'")
+
+    # Seconds to cache data from calls to Workbook. Calls not
+    # listed are made on every collection.
+    cache_ttls = config.get('cache', {}).get('ttl', {})
+    if not isinstance(cache_ttls, dict):
+      raise ValueError("Value ttl in section cache is not a dictionary in config file")
+
+    # Max number of cached calls
+    cache_max_entries = config.get('cache', {}).get('max_entries', 10000)
+    if not isinstance(cache_max_entries, int) or cache_max_entries < 1:
+      raise ValueError("Value max_entries is not a positive integer in config file")
+
+    # Only get time entries since last collection? And how
+    # far back and how often to get all time entries.
+    time_entries_config = config.get('time_entries', {})
+    time_entries_incremental = time_entries_config.get('incremental', False)
+    if not isinstance(time_entries_incremental, bool):
+      raise ValueError("Value incremental in section time_entries is not a boolean in config file")
+
+    time_entries_overlap = time_entries_config.get('overlap', 86400)
+    if not isinstance(time_entries_overlap, (int, float)) or time_entries_overlap < 0:
+      raise ValueError("Value overlap in section time_entries is not a positive number in config file")
+
+    time_entries_full_sync_interval = time_entries_config.get('full_sync_interval', 21600)
+    if not isinstance(time_entries_full_sync_interval, (int, float)) or time_entries_full_sync_interval < 0:
+      raise ValueError("Value full_sync_interval in section time_entries is not a positive number in config file")
+
+    time_entries_page_days = time_entries_config.get('page_days', 1)
+    if not isinstance(time_entries_page_days, (int, float)) or time_entries_page_days <= 0:
+      raise ValueError("Value page_days in section time_entries is not a positive number in config file")
+
+    # Instantiate collector
+    return WorkbookCollector(
+        wb_url,
+        wb_user,
+        wb_password,
+        workers=workers,
+        request_timeout=request_timeout,
+        engine=engine,
+        cache_ttls=cache_ttls,
+        cache_max_entries=cache_max_entries,
+        time_entries_incremental=time_entries_incremental,
+        time_entries_overlap=time_entries_overlap,
+        time_entries_full_sync_interval=time_entries_full_sync_interval,
+        time_entries_page_days=time_entries_page_days,
+        companies=companies,
+        active_jobs=active_jobs,
+        finance_account_types=finance_account_types,
+        limiter=limiter,
+        aggregation_processes=aggregation_processes,
+        changes=changes
+        )
+
+
+def make_collector(config, wb_url, wb_user, wb_password, semaphore=None, start=True,
+    changes=None):
+    '''Returns a collector for the Workbook configured in config. If
+    configured, the collector collects data in the background.
+
+    Keyword arguments:
+    config (Dict): Config with sections workbook, cache, time_entries and exporter
+    wb_url (String): Server url for the Workbook API
+    wb_user (String): User name for logging in to Workbook
+    wb_password (String): Password for logging in to Workbook
+    semaphore (Semaphore): Limits the collections in the background running at a time
+    start (Bool): Start collecting in the background, if configured
+    changes (ChangeStream): Publishes the series changed by every collection. None disables.
+    '''
+
+    # Seconds between collections from Workbook in the background.
+    # If 0, data is collected from Workbook when scraped.
+    refresh_interval = config.get('exporter', {}).get('refresh_interval', 60)
+    if not isinstance(refresh_interval, (int, float)) or refresh_interval < 0:
+      raise ValueError("Value refresh_interval is not a positive number in config file")
+
+    # Seconds between collections of single sections in the background
+    section_intervals = config.get('exporter', {}).get('section_intervals', {})
+    if not isinstance(section_intervals, dict):
+      raise ValueError("Value section_intervals is not a dictionary in config file")
+    for section, interval in section_intervals.items():
+      if section not in WorkbookCollector.SECTIONS:
+        raise ValueError("Section {} in section_intervals is not one of {} in config file"
+          .format(section, ", ".join(WorkbookCollector.SECTIONS.keys())))
+      if not isinstance(interval, (int, float)) or interval <= 0:
+        raise ValueError("Value {} in section_intervals is not a positive number in config file"
+          .format(section))
+    if section_intervals and not refresh_interval:
+      logging.warning("Ignoring section_intervals, because refresh_interval is 0")
+
+    # Max seconds a scrape waits for the collection made for another
+    # scrape, when refresh_interval is 0. If 0, there is no limit.
+    max_scrape_wait = config.get('exporter', {}).get('max_scrape_wait', 0)
+    if not isinstance(max_scrape_wait, (int, float)) or max_scrape_wait < 0:
+      raise ValueError("Value max_scrape_wait is not a positive number in config file")
+
+    # Max fraction of intervals to vary collections by at random
+    jitter = config.get('exporter', {}).get('jitter', 0)
+    if not isinstance(jitter, (int, float)) or not 0 <= jitter < 1:
+      raise ValueError("Value jitter is not a number from 0 to 1 in config file")
+
+    collector = make_workbook_collector(
+      config, wb_url, wb_user, wb_password, changes=changes)
+
+    # File to save the latest snapshot in, to serve right away after restart
+    snapshot_file = config.get('exporter', {}).get('snapshot_file', None)
+
+    if refresh_interval:
+      # Serve the latest snapshot collected in the background
+      snapshot_collector = SnapshotCollector(
+        collector,
+        snapshot_file,
+        refresh_interval=refresh_interval,
+        section_intervals=section_intervals,
+        jitter=jitter,
+        semaphore=semaphore)
+      if snapshot_file:
+        snapshot_collector.load()
+      if start:
+        snapshot_collector.start()
+      return snapshot_collector
+
+    # Collect when scraped, once for scrapes at the same time
+    return CoalescingCollector(collector, max_scrape_wait)
+
+
 def main():
     
     try:
@@ -1059,29 +4628,11 @@ def main():
         config = parse_config(args.conf_file)
 
         # Fall back to credentials in config file
-        if not wb_url:
+        if not wb_url and 'tenants' not in config:
           wb_url = config['workbook']['url']
           wb_user = config['workbook']['user']
           wb_password = config['workbook']['password']
 
-        # Jobs with these states are considered active
-        global ACTIVE_JOBS
-        ACTIVE_JOBS = config['workbook'].get('active_jobs', [0,1,2,3])
-        if not isinstance(ACTIVE_JOBS, list):
-          raise ValueError("Active job states is not a list")
-
-        # Only get data on these companies. If empty list,
-        # get data for all companies in Workbook
-        global COMPANIES_TO_GET
-        COMPANIES_TO_GET = config['workbook'].get('companies', [])
-        if not isinstance(COMPANIES_TO_GET, list):
-          raise ValueError("Value companies is not a list in config file")
-
-        global FINANCE_ACCOUNT_TYPES
-        FINANCE_ACCOUNT_TYPES = config['workbook'].get('finance_account_types', [3])
-        if not isinstance(FINANCE_ACCOUNT_TYPES, list):
-          raise ValueError("Value finance_account_types is not a list in config file")
-
         global JOB_AGE_BUCKETS
         JOB_AGE_BUCKETS = config['data'].get('job_age_buckets')
         if not isinstance(JOB_AGE_BUCKETS, list):
@@ -1092,18 +4643,71 @@ def main():
         if not isinstance(CLIENT_AGE_BUCKETS, list):
           raise ValueError("Value client_age_buckets is not a list in config file")
 
-
-        # Instantiate collector
-        REGISTRY.register(
-            WorkbookCollector(
-                wb_url,
-                wb_user,
-                wb_password
-                )
-            )
+        # Max number of collections in the background running at a
+        # time, for all tenants. If 0, there is no limit.
+        max_concurrent_collections = config.get('exporter', {}).get('max_concurrent_collections', 0)
+        if not isinstance(max_concurrent_collections, int) or max_concurrent_collections < 0:
+          raise ValueError("Value max_concurrent_collections is not a positive integer in config file")
+        semaphore = None
+        if max_concurrent_collections:
+          semaphore = threading.BoundedSemaphore(max_concurrent_collections)
+
+        # Do not collect in the background when only profiling
+        start = args.profile is None
+
+        # Publishes the series changed by every collection
+        publisher = make_change_publisher(config) if start else None
+
+        # Config and credentials pr. Workbook, with tenant names as keys
+        if 'tenants' in config:
+          workbooks = {tenant: (
+            tenant_config,
+            tenant_config['workbook'].get('url'),
+            tenant_config['workbook'].get('user'),
+            tenant_config['workbook'].get('password'))
+            for tenant, tenant_config in tenant_configs(config).items()}
+        else:
+          workbooks = {'': (config, wb_url, wb_user, wb_password)}
+
+        # A collector pr. Workbook, labelled with the tenant name
+        collectors = {}
+        for tenant, workbook in workbooks.items():
+          if tenant:
+            logging.info("Setting up tenant {}".format(tenant))
+          collectors[tenant] = make_collector(*workbook, semaphore, start,
+            ChangeStream(publisher, tenant or None) if publisher else None)
+
+        if 'tenants' in config:
+          collector = TenantsCollector(collectors)
+        else:
+          collector = collectors['']
+
+        # Collectors to profile. They are not the collectors serving metrics,
+        # so profiles never overlap their collections, or change the data
+        # they keep, and publish no changes. Requests to Workbook share the
+        # rate limit of the collectors serving metrics.
+        profile_collectors = None
+        if args.profile or args.enable_debug_profile:
+          profile_collectors = {tenant: make_workbook_collector(*workbook,
+            limiter=collectors[tenant].collector.limiter)
+            for tenant, workbook in workbooks.items()}
+
+        if args.profile:
+          with open(args.profile, 'w') as f:
+            for tenant, c in profile_collectors.items():
+              if tenant:
+                f.write("Tenant {}\n".format(tenant))
+              f.write(profile_collection(c, args.profile_cycles))
+          logging.info("Wrote profile to {}".format(args.profile))
+          exit(0)
+
+        REGISTRY.register(collector)
+        if publisher:
+          REGISTRY.register(publisher)
 
         # Listen for scrape requests.
-        start_http_server(args.port)
+        start_exporter_http_server(args.port,
+          profile_collectors if args.enable_debug_profile else None)
 
         # Run forever
         while True: